@@ -0,0 +1,67 @@
+import numpy as np
+from multiprocessing import Pool, shared_memory
+import os
+import Instrument
+
+# set in each worker process by attachMapping()
+workerMemory = None
+workerMapping = None
+
+def shareMapping(mapping):
+	# copy the mapping LUT once into a named shared memory block the workers can attach to
+	memory = shared_memory.SharedMemory(create=True, size=mapping.nbytes)
+	shared = np.ndarray(mapping.shape, dtype=np.uint32, buffer=memory.buf)
+	shared[:] = mapping
+	return memory
+
+def attachMapping(name, shape, instrumented=False):
+	global workerMemory, workerMapping
+	if instrumented:
+		Instrument.startWorker()
+	if name is None:
+		return
+	workerMemory = shared_memory.SharedMemory(name=name)
+	workerMapping = np.ndarray(shape, dtype=np.uint32, buffer=workerMemory.buf)
+
+def runJob(job):
+	process, inputFileName, outputFileName = job
+	try:
+		if workerMapping is not None:
+			process(inputFileName, outputFileName, workerMapping)
+		else:
+			process(inputFileName, outputFileName)
+		return inputFileName, outputFileName, None, Instrument.take()
+	except Exception as e:
+		return inputFileName, outputFileName, e, Instrument.take()
+
+def processBatch(jobs, process, workers=0, mapping=None, done=None):
+	# jobs is a list of (inputFileName, outputFileName) pairs;
+	# process(inputFileName, outputFileName[, mapping]) must be a module-level function;
+	# done(inputFileName, outputFileName) is called in this process for each successful job
+	if len(jobs) == 0:
+		return 0, 0
+	if workers <= 0:
+		workers = os.cpu_count() or 1
+	workers = max(1, min(workers, len(jobs)))
+	chunksize = max(1, len(jobs) // (workers * 4))
+	memory = shareMapping(mapping) if mapping is not None else None
+	initargs = ((memory.name, mapping.shape) if memory is not None else (None, None)) + (Instrument.enabled(),)
+	imagesProcessedCount, errorCount = 0, 0
+	print("\nProcessing {} image file(s) with {} worker process(es)...".format(len(jobs), workers))
+	try:
+		with Pool(workers, initializer=attachMapping, initargs=initargs) as pool:
+			for inputFileName, outputFileName, error, stages in pool.imap_unordered(runJob, [(process,) + tuple(job) for job in jobs], chunksize):
+				Instrument.merge(stages)
+				if error is None:
+					imagesProcessedCount += 1
+					if done is not None:
+						done(inputFileName, outputFileName)
+				else:
+					print("Error while processing image file \"{}\":".format(inputFileName))
+					print(error)
+					errorCount += 1
+	finally:
+		if memory is not None:
+			memory.close()
+			memory.unlink()
+	return imagesProcessedCount, errorCount
@@ -0,0 +1,388 @@
+import numpy as np
+from PIL import Image
+import os, os.path
+import sys
+import io
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+import itertools
+import statistics
+import tracemalloc
+import contextlib
+from datetime import datetime, timezone
+from Headless import Gooey, GooeyParser
+from Mapping import loadMappingFromFile, parseMappingFile
+from ReverseColors import transformImageColors
+from Transparent import remove_black
+from Video import frames
+from Gif import number, gif
+from Converter import makeAnimation
+try:
+	import resource
+except ImportError: # Windows
+	resource = None
+
+# times every stage on synthetic fixtures and keeps the results as json,
+# so a run can be compared with an earlier one (same settings, same seed)
+
+BENCHMARK_VERSION = 2 # 2: peak memory is the RSS peak of a forked run where possible
+
+def stageResult(stage, times, peak, items, unit):
+	best = min(times)
+	return {
+		"stage": stage,
+		"seconds": best, # best of the repeats, the least noisy
+		"median": statistics.median(times),
+		"items": items,
+		"unit": unit,
+		"throughput": items / best if best > 0 else 0,
+		"peak_mb": peak / 2**20 if peak is not None else None,
+		"peak_source": None if peak is None else ("rss" if canFork() else "traced"),
+	}
+
+def canFork():
+	return resource is not None and hasattr(os, "fork")
+
+def rssPeak():
+	scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is in bytes on macOS, kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def forkedPeak(run):
+	# runs run() in a forked child and returns how far its peak RSS rose during the run;
+	# unlike tracemalloc, RSS also sees Pillow's C image buffers and memory-mapped files.
+	# The parent's own peak can't be reset, hence the child
+	sys.stdout.flush()
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		peak = -1
+		try:
+			start = rssPeak()
+			run()
+			peak = rssPeak() - start
+		finally:
+			os.write(write, str(peak).encode())
+			os._exit(0)
+	os.close(write)
+	with os.fdopen(read) as pipe:
+		peak = int(pipe.read() or -1)
+	os.waitpid(pid, 0)
+	return peak if peak >= 0 else None
+
+def peakMemory(work, setup=None):
+	# one extra, untimed run of the stage
+	if setup is not None:
+		setup()
+	gc.collect()
+	def run():
+		with contextlib.redirect_stdout(io.StringIO()):
+			work()
+	if canFork():
+		return forkedPeak(run)
+	tracemalloc.start() # no fork (Windows): Python and numpy allocations only
+	try:
+		run()
+		_, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return peak
+
+def measure(stage, work, items, unit, repeat=1, memory=True, setup=None):
+	# work() runs the stage once on the fixtures; its printing is swallowed.
+	# items can be a function, when the amount of work is only known afterwards.
+	# Timed runs are unmeasured, peak memory comes from one extra run
+	times = []
+	for i in range(repeat):
+		if setup is not None:
+			setup()
+		gc.collect()
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			work()
+			elapsed = time.perf_counter() - start
+		times.append(elapsed)
+	peak = peakMemory(work, setup) if memory else None
+	result = stageResult(stage, times, peak, items() if callable(items) else items, unit)
+	print("{:<32} {:>9.3f}s {:>12.1f} {}/s {:>10}".format(stage, result["seconds"], result["throughput"], unit,
+		"{:.1f}MB".format(result["peak_mb"]) if result["peak_mb"] is not None else "-"))
+	return result
+
+def generatedColors(count, rng, step=8):
+	# distinct colors on an RGB555-like grid, clear of black
+	levels = np.arange(step, 256, step)
+	grid = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).reshape(-1, 3)
+	return grid[rng.choice(len(grid), min(count, len(grid)), replace=False)]
+
+def writeMapping(fileName, colors, tolerance, rng):
+	# same layout as GeneratePalette: every color within tolerance of a generated color, then black -> transparency
+	offsets = list(itertools.product(range(-tolerance, tolerance+1), repeat=3))
+	oldColors = rng.integers(0, 256, size=(len(colors), 3))
+	lines = ["# Synthetic inverse palette mapping", ""]
+	for color, oldColor in zip(colors.tolist(), oldColors.tolist()):
+		suffix = " : rgb({:>3}, {:>3}, {:>3})".format(*oldColor)
+		for dr, dg, db in offsets:
+			lines.append("rgb({:>3}, {:>3}, {:>3})".format(color[0]+dr, color[1]+dg, color[2]+db) + suffix)
+	lines.append("# Transparency")
+	lines.append("rgb(  0,   0,   0) : rgba(  0,   0,   0,   0)")
+	with open(fileName, "w") as mappingFile:
+		mappingFile.write("\n".join(lines))
+	return len(colors) * len(offsets) + 1
+
+def paintFrames(folder, count, width, height, colors, rng):
+	# black background with a few moving blocks painted in generated colors, like a sprite on a cleared stage
+	os.makedirs(folder, exist_ok=True)
+	fileNames, arrays = [], []
+	for i in range(count):
+		frame = np.zeros((height, width, 4), dtype=np.uint8)
+		frame[..., 3] = 255
+		for block in range(8):
+			w, h = int(rng.integers(4, width // 4)), int(rng.integers(4, height // 4))
+			x, y = (i * 3 + block * width // 8) % (width - w), int(rng.integers(0, height - h))
+			frame[y:y+h, x:x+w, :3] = colors[rng.integers(0, len(colors))]
+		fileName = os.path.join(folder, f"frame#{i+1}.png")
+		Image.fromarray(frame).save(fileName)
+		fileNames.append(fileName)
+		arrays.append(frame)
+	return fileNames, arrays
+
+def writeVideo(fileName, arrays, fps):
+	from moviepy.editor import ImageSequenceClip # only needed for this fixture
+	clip = ImageSequenceClip([frame[..., :3] for frame in arrays], fps=fps)
+	with contextlib.redirect_stdout(io.StringIO()):
+		clip.write_videofile(fileName, codec="libx264", audio=False, logger=None)
+	clip.close()
+
+def writeFakePalette(template, fileName, rng):
+	# same size and layout as a real pal_a.bin, random colors
+	with open(template, "rb") as templateFile:
+		size = len(templateFile.read())
+	with open(fileName, "wb") as paletteFile:
+		paletteFile.write(rng.integers(0, 256, size=size, dtype=np.uint8).tobytes())
+
+def benchmarkPalette(template, work, rng, repeat, memory):
+	results = []
+	try:
+		from GeneratePalette import generatePalette, MIN_TOLERANCE, MAX_TOLERANCE
+	except ImportError as e:
+		print("Skipping generatePalette (needs the Base/ modules): {}".format(e))
+		return results
+	if not os.path.exists(template):
+		print("Skipping generatePalette: no pal_a.bin to take the shape from at \"{}\"".format(template))
+		return results
+	inFolder = os.path.join(work, "palette_in")
+	os.makedirs(inFolder, exist_ok=True)
+	inFileName = os.path.join(inFolder, "pal_a.bin")
+	writeFakePalette(template, inFileName, rng)
+	for tolerance in range(MIN_TOLERANCE, MAX_TOLERANCE+1):
+		outFolder = os.path.join(work, "palette_out_{}".format(tolerance))
+		mappingFileName = os.path.join(outFolder, "inversePaletteMapping.txt")
+		def run():
+			generatePalette(inFileName, os.path.join(outFolder, "pal_a.bin"), mappingFileName, tolerance)
+		try:
+			results.append(measure("generatePalette t={}".format(tolerance), run, lambda: len(parseMappingFile(mappingFileName)[0]), "mappings", repeat, memory))
+		except Exception as e: # e.g. running out of colors at high tolerances
+			print("generatePalette t={} failed: {}".format(tolerance, e))
+	return results
+
+def gifFrameCount(data):
+	# frames a strict decoder gets out of a gif: it stops at the first block that isn't an extension,
+	# an image or the trailer (e.g. a second header in the middle of the stream)
+	def skipSubBlocks(i):
+		while data[i] != 0:
+			i += data[i] + 1
+		return i + 1
+	def colorTableSize(flags):
+		return 3 << ((flags & 0x07) + 1) if flags & 0x80 else 0
+	i = 13 + colorTableSize(data[10]) # header, logical screen descriptor, global color table
+	count = 0
+	while i < len(data):
+		if data[i] == 0x21: # extension
+			i = skipSubBlocks(i + 2)
+		elif data[i] == 0x2C: # image descriptor, local color table, lzw code size, image data
+			i = skipSubBlocks(i + 11 + colorTableSize(data[i + 9]))
+			count += 1
+		else: # 0x3B trailer, or anything a decoder gives up on
+			break
+	return count
+
+def checkGifs(work):
+	# regression check: a fully transparent frame in the middle of a known palette gif must not cut it short
+	arrays = []
+	for i in range(12):
+		frame = np.zeros((32, 32, 4), dtype=np.uint8)
+		if i != 5:
+			frame[i:i+8, i:i+8] = (200, 10 * i, 30, 255)
+		arrays.append(frame)
+	folder = os.path.join(work, "check")
+	os.makedirs(folder, exist_ok=True)
+	fileNames = []
+	for i, frame in enumerate(arrays):
+		fileNames.append(os.path.join(folder, f"frame#{i+1}.png"))
+		Image.fromarray(frame).save(fileNames[-1])
+	gifFileName = os.path.join(folder, "check.gif")
+	outputs = {}
+	for stream, delta in itertools.product((False, True), repeat=2):
+		with contextlib.redirect_stdout(io.StringIO()):
+			gif(fileNames, 1, 1, 2, len(fileNames), 1000/60, False, gifFileName, stream, True, delta)
+		with open(gifFileName, "rb") as gifFile:
+			outputs["Gif.gif (known palette, stream={}, delta={})".format(stream, delta)] = gifFile.read()
+		outputs["makeAnimation (known palette, delta={})".format(delta)] = makeAnimation(arrays, known=True, delta=delta)[0]
+	for name, data in outputs.items():
+		count = gifFrameCount(data)
+		if count != len(arrays):
+			raise AssertionError("{} decodes to {} of {} frames".format(name, count, len(arrays)))
+
+def runBenchmarks(work, count=60, width=320, height=224, colors=2000, tolerance=2, fps=30, repeat=3, memory=True, template="pal_a.bin", seed=0):
+	checkGifs(work)
+	rng = np.random.default_rng(seed)
+	results = benchmarkPalette(template, work, rng, repeat, memory)
+
+	palette = generatedColors(colors, rng)
+	mappingFileName = os.path.join(work, "inversePaletteMapping.txt")
+	entries = writeMapping(mappingFileName, palette, tolerance, rng)
+	framesFolder = os.path.join(work, "frames")
+	fileNames, arrays = paintFrames(framesFolder, count, width, height, palette, rng)
+	videoFileName = os.path.join(work, "video.mp4")
+	writeVideo(videoFileName, arrays, fps)
+	pixels = count * width * height / 1e6
+
+	results.append(measure("loadMappingFromFile (text)", lambda: loadMappingFromFile(mappingFileName, False), entries, "entries", repeat, memory))
+	with contextlib.redirect_stdout(io.StringIO()):
+		mapping = loadMappingFromFile(mappingFileName, True) # writes the compiled copy for the next stage
+	results.append(measure("loadMappingFromFile (compiled)", lambda: np.asarray(loadMappingFromFile(mappingFileName, True)).sum(), entries, "entries", repeat, memory))
+	images = [Image.fromarray(frame) for frame in arrays]
+	results.append(measure("transformImageColors", lambda: [transformImageColors(image, mapping) for image in images], pixels, "Mpx", repeat, memory))
+	results.append(measure("remove_black", lambda: [remove_black(fileName) for fileName in fileNames], count, "frames", repeat, memory))
+
+	videoOut = os.path.join(work, "extracted")
+	clearExtracted = lambda: shutil.rmtree(videoOut, ignore_errors=True)
+	results.append(measure("frames", lambda: frames(videoFileName, 0, videoOut, 0, True), count, "frames", repeat, memory, clearExtracted))
+
+	files = sorted(fileNames, key=number)
+	gifFileName = os.path.join(work, "benchmark.gif")
+	results.append(measure("Gif.gif", lambda: gif(files, 1, 1, 2, len(files), 1000/60, True, gifFileName), count, "frames", repeat, memory))
+	results.append(measure("Gif.gif (low memory)", lambda: gif(files, 1, 1, 2, len(files), 1000/60, True, gifFileName, True), count, "frames", repeat, memory))
+	results.append(measure("Gif.gif (known palette)", lambda: gif(files, 1, 1, 2, len(files), 1000/60, True, gifFileName, True, True), count, "frames", repeat, memory))
+	return results
+
+def environment():
+	import PIL
+	return {
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"pillow": PIL.__version__,
+		"platform": platform.platform(),
+		"processor": platform.processor(),
+		"cpus": os.cpu_count(),
+	}
+
+def compareResults(results, previousFileName):
+	with open(previousFileName, "r") as previousFile:
+		previous = json.load(previousFile)
+	before = {result["stage"]: result for result in previous["results"]}
+	print("\nCompared with {} ({}):".format(previousFileName, previous.get("date", "?")))
+	for result in results:
+		if result["stage"] not in before:
+			continue
+		old = before[result["stage"]]
+		ratio = result["seconds"] / old["seconds"] if old["seconds"] > 0 else float("inf")
+		print("{:<32} {:>9.3f}s -> {:>9.3f}s  x{:.2f} {}".format(result["stage"], old["seconds"], result["seconds"], ratio,
+			"slower" if ratio > 1.05 else ("faster" if ratio < 0.95 else "")))
+	return previous
+
+@Gooey(program_description="Times every stage (palette generation, mapping load, color reversal, transparency, frame extraction, gif) on synthetic fixtures.", default_size=(690, 600), optional_cols=2)
+def main():
+	cwd = os.path.abspath(os.getcwd())
+	parser = GooeyParser()
+	parser.add_argument("-r", "--report",
+		default=os.path.join(cwd, "benchmark.json"),
+		help="Json file to write the results to.",
+		widget="FileSaver")
+	parser.add_argument("-c", "--compare",
+		default="",
+		help="Results of an earlier run to compare with.",
+		widget="FileChooser")
+	parser.add_argument("-p", "--palette",
+		default=os.path.join(cwd, "pal_a.bin"),
+		help="A real pal_a.bin; only its size is used for the random one. The palette stages are skipped without it.",
+		widget="FileChooser")
+	parser.add_argument("-f", "--frames",
+		type=int,
+		default=60,
+		help="Number of synthetic frames (and video frames).",
+		widget="IntegerField")
+	parser.add_argument("-s", "--size",
+		default="320x224",
+		help="Frame size, width x height.")
+	parser.add_argument("-k", "--colors",
+		type=int,
+		default=2000,
+		help="Number of generated colors in the synthetic mapping.",
+		widget="IntegerField")
+	parser.add_argument("-t", "--tolerance",
+		type=int,
+		default=2,
+		help="Tolerance of the synthetic mapping.",
+		widget="IntegerField")
+	parser.add_argument("-n", "--repeat",
+		type=int,
+		default=3,
+		help="Timed runs per stage; the best one is reported.",
+		widget="IntegerField")
+	parser.add_argument("--seed",
+		type=int,
+		default=0,
+		help="Random seed for the fixtures. Keep it the same to compare runs.",
+		widget="IntegerField")
+	parser.add_argument("-nm", "--no_memory",
+		action="store_true",
+		help="Skip the extra run that measures peak memory.")
+	parser.add_argument("-w", "--work",
+		default="",
+		help="Folder for the fixtures, kept afterwards. Defaults to a temporary folder.",
+		widget="DirChooser")
+
+	args = vars(parser.parse_args())
+	width, height = (int(x) for x in args["size"].lower().split("x"))
+	settings = {
+		"version": BENCHMARK_VERSION,
+		"frames": args["frames"],
+		"size": [width, height],
+		"colors": args["colors"],
+		"tolerance": args["tolerance"],
+		"repeat": args["repeat"],
+		"seed": args["seed"],
+	}
+	work = args["work"] or tempfile.mkdtemp(prefix="benchmark")
+	os.makedirs(work, exist_ok=True)
+	print("{:<32} {:>10} {:>18} {:>10}".format("stage", "time", "throughput", "peak"))
+	try:
+		results = runBenchmarks(work, args["frames"], width, height, args["colors"], args["tolerance"], 30, args["repeat"],
+			not args["no_memory"], os.path.abspath(args["palette"]), args["seed"])
+	finally:
+		if not args["work"]:
+			shutil.rmtree(work, ignore_errors=True)
+
+	report = {
+		"date": datetime.now(timezone.utc).isoformat(),
+		"settings": settings,
+		"environment": environment(),
+		"results": results,
+	}
+	if args["compare"]:
+		previous = compareResults(results, args["compare"])
+		if previous.get("settings") != settings:
+			print("WARNING: The earlier run used different settings, the numbers aren't directly comparable.")
+	with open(args["report"], "w") as reportFile:
+		json.dump(report, reportFile, indent=1)
+	print("\nWrote benchmark results to: " + args["report"])
+	return 0
+
+if __name__ == "__main__":
+	result = main()
+	sys.exit(result)
@@ -0,0 +1,243 @@
+import numpy as np
+from PIL import Image
+import os.path
+import time
+import sys
+import glob
+from Headless import Gooey, GooeyParser
+from Mapping import loadMappingFromFile
+from Video import VIDEO_EXTENSIONS, countFrames, iterFrames
+from ReverseColors import transformImageColors
+from Transparent import remove_black_frame
+from Gif import number, parseGap, normalizeSelection, selectFrames, cropFrames, saveGif
+
+def folderFrames(folder, start, pause, restart, end):
+	files = sorted(glob.glob(os.path.join(glob.escape(folder), "*.png")), key=number) #sorts the files by frame#number
+	numbered = list(enumerate(files, 1))
+	selection = selectFrames(numbered, *normalizeSelection(len(numbered), start, pause, restart, end))
+	for frameNumber, file in selection:
+		yield frameNumber, Image.open(file).convert("RGBA")
+
+def videoFrames(file, videoStart, fps, start, pause, restart, end):
+	count = countFrames(file, videoStart, fps)
+	selection = selectFrames(list(range(1, count+1)), *normalizeSelection(count, start, pause, restart, end))
+	wanted = set(selection)
+	decoded = {}
+	for frameNumber, (now, frame) in enumerate(iterFrames(file, videoStart, fps), 1):
+		if frameNumber in wanted:
+			decoded[frameNumber] = frame
+			if len(decoded) == len(wanted):
+				break
+	for frameNumber in selection:
+		yield frameNumber, decoded[frameNumber]
+
+def saveCheckpoint(checkpoint, stage, frameNumber, image):
+	if len(checkpoint) == 0:
+		return
+	folder = os.path.join(checkpoint, stage)
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	image.save(os.path.join(folder, f"frame#{frameNumber}.png"))
+
+def chain(frames, mapping=None, transparent=False, crop=False, gap=1000/60, output="GIF.gif", checkpoint=""):
+	# frames is an iterable of (frame number, RGBA array or image);
+	# every stage runs in memory and only the gif (plus optional checkpoints) is written
+	frameNumbers, images = [], []
+	for frameNumber, frame in frames:
+		image = frame
+		if mapping is not None:
+			image = transformImageColors(image, mapping)
+			saveCheckpoint(checkpoint, "reversed", frameNumber, image)
+		if transparent:
+			image = remove_black_frame(image)
+			saveCheckpoint(checkpoint, "transparent", frameNumber, image)
+		if isinstance(image, np.ndarray):
+			image = Image.fromarray(image)
+		frameNumbers.append(frameNumber)
+		images.append(image)
+
+	if len(images) == 0:
+		return 0
+	if crop == True:
+		images = cropFrames(images)
+		for frameNumber, image in zip(frameNumbers, images):
+			saveCheckpoint(checkpoint, "cropped", frameNumber, image)
+
+	saveGif(images, gap, output)
+	return len(images)
+
+@Gooey(program_description="Reverts the palette, removes black, autocrops and makes a gif in a single pass over the frames.", default_size=(690, 600), optional_cols=1, tabbed_groups=True)
+def main():
+	cwd = os.path.abspath(os.getcwd())
+	defaultInversePaletteMappingFileName = "new_palette\inversePaletteMapping.txt"
+	defaultOutputPath = "output"
+
+	parser = GooeyParser()
+	input_group = parser.add_argument_group(
+		"Input",
+		"Name the video, or the folder containing the numbered png files.")
+	input_group.add_argument("-fi", "--inputFile",
+		default="",
+		help="Name/path of the video to process.",
+		widget="FileChooser")
+	input_group.add_argument("-if", "--inputFolder",
+		default="",
+		help="Folder name/path containing the png frames to process.",
+		widget="DirChooser")
+	input_group.add_argument("-m", "--mapping",
+		dest="mapping",
+		default=os.path.join(cwd, defaultInversePaletteMappingFileName),
+		help="Name/path of inverse palette mapping file.",
+		widget="FileChooser")
+	input_group.add_argument("-vs", "--video_start",
+		type=float,
+		default=0,
+		help="Time in seconds at which to start reading frames from the video. Defaults to 0.",
+		widget="DecimalField",
+		gooey_options={'max':1000})
+	input_group.add_argument("-i", "--fps",
+		type=float,
+		default=0,
+		help="Number of frames per second to read from the video. Defaults to every frame.",
+		widget="DecimalField")
+
+	stage_group = parser.add_argument_group(
+		"Stages",
+		"Pick the stages to run on every frame.")
+	stage_group.add_argument("-nr", "--no_reverse",
+		action="store_true",
+		help="Skip reverting the generated palettes to the originals.")
+	stage_group.add_argument("-t", "--transparent",
+		action="store_true",
+		help="Change true black into full transparency.")
+	stage_group.add_argument("-c", "--crop",
+		action="store_true",
+		help="Autocrops transparency before making the gif.")
+
+	gif_group = parser.add_argument_group(
+		"Gif Options",
+		"Set the parameters for the gif creation.")
+	gif_group.add_argument("-s", "--start",
+		type=int,
+		default=1,
+		help="Frame# to start the gif.",
+		widget="IntegerField",
+		gooey_options={'max':10000})
+	gif_group.add_argument("-p", "--pause",
+		type=int,
+		default=1,
+		help="Frame# to pause the gif. Equate restart to omit.",
+		widget="IntegerField",
+		gooey_options={'max':10000})
+	gif_group.add_argument("-r", "--restart",
+		type=int,
+		default=1,
+		help="Frame# to restart the gif. Equate pause to omit.",
+		widget="IntegerField",
+		gooey_options={'max':10000})
+	gif_group.add_argument("-e", "--end",
+		type=int,
+		default=0,
+		help="Frame# to end the gif. Put 0 for all frames.",
+		widget="IntegerField",
+		gooey_options={'max':10000})
+	gif_group.add_argument("-g", "--gap",
+		default="60 fps",
+		help="Time in ms between frames. You can write in fps. 1000/50 or 20 or 50fps are equivalent.")
+
+	output_group = parser.add_argument_group(
+		"Output",
+		"Customize output options.")
+	output_group.add_argument("-of", "--outputFolder",
+		default=os.path.join(cwd, defaultOutputPath),
+		help="Folder name/path to save the gif.",
+		widget="DirChooser")
+	output_group.add_argument("-n", "--name",
+		default="GIF",
+		help="Name for the output gif file. Defaults to 'GIF'.")
+	output_group.add_argument("-k", "--checkpoint",
+		default="",
+		help="Optional folder name/path where the frames are also saved after each stage.",
+		widget="DirChooser")
+	output_group.add_argument("-d", "--default",
+		action="store_true",
+		help="Set the current values as the new default configuration.")
+
+	args = vars(parser.parse_args()) # convert parsed arguments into dict
+	inputFile = args["inputFile"]
+	folder = args["inputFolder"]
+	video_start = args["video_start"]
+	fps = args["fps"]
+	start = args["start"]
+	pause = args["pause"]
+	restart = args["restart"]
+	end = args["end"]
+	gap = parseGap(args["gap"])
+	name = args["name"]
+	checkpoint = args["checkpoint"]
+	default = args["default"]
+
+	if inputFile and any(vid in inputFile.lower() for vid in VIDEO_EXTENSIONS):
+		frames = videoFrames(inputFile, video_start, fps, start, pause, restart, end)
+	elif folder and os.path.isdir(folder):
+		frames = folderFrames(folder, start, pause, restart, end)
+	else:
+		parser.print_help()
+		sys.exit()
+
+	out = os.path.abspath(args["outputFolder"])
+	if not os.path.exists(out):
+		os.makedirs(out)
+		print("Created output directory \"{}\"".format(out))
+	new = name + ".gif"
+	output = os.path.join(out, new)
+	j=2
+	while os.path.exists(output):
+		new = name + f"#{j}.gif"
+		output = os.path.join(out, new)
+		j+=1
+
+	go = time.perf_counter()
+	mapping = None
+	if not args["no_reverse"]:
+		mapping = loadMappingFromFile(os.path.abspath(args["mapping"]))
+	count = chain(frames, mapping, args["transparent"], args["crop"], gap, output, checkpoint)
+	stop = time.perf_counter()
+	elapsed = stop - go
+	if count == 0:
+		print("\nNo frames found to gather into a gif.")
+	else:
+		print("\nGathered {} frame(s) into {} in {:.3f}s".format(count, new, elapsed))
+
+	if default == True:
+		inputFile = repr(inputFile) #Convert quotes into double quotes so the address is written later with quotes + deal with escape characters
+		folder = repr(folder)
+		mapping = repr(args["mapping"])
+		gap = repr(args["gap"])
+		output = repr(args["outputFolder"])
+		name = repr(name)
+		checkpoint = repr(checkpoint)
+		data=[inputFile, folder, mapping, video_start, fps, start, pause, restart, end, gap, output, name, checkpoint]
+		j=0
+		with open("Chain.py","r") as e:
+			new = e.read().splitlines(True) #Grab each line and keep the \n endline character
+			e.close()
+		for i in range(len(data)):
+			while new[j].find("default=") == -1:
+				j+=1
+			l = new[j].split("default=")
+			new_line = l[0] + "default=" + str(data[i]) + ',\n'
+			if new[j-1].find('#') == -1 and new[j] != new_line:
+				new[j] = '#' + new[j].replace("default=","default(base)=")
+				j+=1
+				new.insert(j, new_line)
+			else:
+				new[j] = new_line
+			j+=1
+		with open("Chain.py","w") as e:
+			e.write(''.join(new))
+			e.close()
+
+if __name__ == "__main__":
+	result = main()
+	sys.exit(result)
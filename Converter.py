@@ -0,0 +1,187 @@
+import numpy as np
+from PIL import Image
+import io
+import os.path
+import time
+import tempfile
+import threading
+import contextlib
+from Mapping import mappingDistance, readMappingDistance, parseMappingFile, parseMappingLines, buildMapping, loadCompiledMapping, saveCompiledMapping
+from ReverseColors import transformFrames
+from Transparent import remove_black_array
+from Video import rgbToRGBA
+from Encode import pngOptions
+from Gif import parseGap, cropFrames, newHistogram, colorHistogram, knownPalette, indexFrame, streamGif, ANIMATION_WRITERS
+
+# the scripts' work as an importable API: takes numpy arrays, encoded image bytes, PIL images
+# or iterables of them, returns (results, stats) and never prints, so a long-lived worker
+# can serve many jobs with one mapping kept in memory
+
+def toFrame(item):
+	# one frame as an (H, W, 4) uint8 RGBA array
+	if isinstance(item, (bytes, bytearray, memoryview)):
+		item = Image.open(io.BytesIO(item))
+	if isinstance(item, Image.Image):
+		return np.asarray(item.convert("RGBA"))
+	array = np.asarray(item, dtype=np.uint8)
+	if array.ndim != 3 or array.shape[-1] not in (3, 4):
+		raise ValueError("Expected an (H, W, 3) or (H, W, 4) frame, got an array of shape {}".format(array.shape))
+	return rgbToRGBA(array) if array.shape[-1] == 3 else array
+
+def toFrames(frames):
+	# a single frame, an (N, H, W, C) stack or any iterable of frames
+	if isinstance(frames, (bytes, bytearray, memoryview, Image.Image)) or (isinstance(frames, np.ndarray) and frames.ndim == 3):
+		return [toFrame(frames)]
+	return [toFrame(frame) for frame in frames]
+
+def encodePng(frame, options=None):
+	buffer = io.BytesIO()
+	Image.fromarray(frame).save(buffer, format="PNG", **(options or {}))
+	return buffer.getvalue()
+
+def finishFrames(frames, png):
+	# png: None to return arrays, or a PNG profile name (see Encode.py) to return encoded bytes
+	if png is None:
+		return frames
+	options = pngOptions(png)
+	return [encodePng(frame, options) for frame in frames]
+
+def jobStats(start, count, **extra):
+	elapsed = time.perf_counter() - start
+	return dict({"frames": count, "seconds": elapsed, "fps": count / elapsed if elapsed > 0 else 0}, **extra)
+
+class ColorMapping:
+	# an inverse palette mapping (the 2^24 entry LUT) loaded once and reused by every job;
+	# safe to share between threads, each one gets its own transform buffers
+	def __init__(self, lut, fileName=None, distance=0, loadSeconds=0):
+		self.lut = lut
+		self.fileName = fileName
+		self.distance = distance
+		self.loadSeconds = loadSeconds
+		self.local = threading.local()
+
+	@classmethod
+	def load(cls, fileName, compiled=True, distance=None, preload=True):
+		# same lookup as loadMappingFromFile: the compiled copy if there is one, otherwise parse (and compile) the text file.
+		# preload reads a memory-mapped compiled copy into memory right away instead of during the first jobs
+		start = time.perf_counter()
+		if distance is None:
+			distance = readMappingDistance(fileName)
+		lut = loadCompiledMapping(fileName, distance) if compiled else None
+		if lut is None:
+			lut = buildMapping(*parseMappingFile(fileName), distance)
+			if compiled:
+				try:
+					saveCompiledMapping(fileName, lut, distance)
+				except OSError: # e.g. a read-only folder, the parsed mapping works all the same
+					pass
+		elif preload:
+			lut = np.array(lut)
+		return cls(lut, os.path.abspath(fileName), distance, time.perf_counter() - start)
+
+	@classmethod
+	def fromText(cls, text, distance=None):
+		# from the contents of a mapping file, e.g. the mapping returned by generatePalette()
+		start = time.perf_counter()
+		lines = text.splitlines()
+		if distance is None:
+			distance = mappingDistance(lines)
+		lut = buildMapping(*parseMappingLines(lines), distance)
+		return cls(lut, None, distance, time.perf_counter() - start)
+
+	def buffers(self):
+		if not hasattr(self.local, "buffers"):
+			self.local.buffers = {}
+		return self.local.buffers
+
+	def transform(self, frames, batch=32):
+		# frames are reversed in stacks of up to batch frames of the same size; returns new arrays
+		results = [None] * len(frames)
+		groups = {}
+		for i, frame in enumerate(frames):
+			groups.setdefault(frame.shape, []).append(i)
+		for shape, indices in groups.items():
+			for j in range(0, len(indices), batch):
+				chunk = indices[j:j+batch]
+				transformed = transformFrames(np.stack([frames[i] for i in chunk]), self.lut, self.buffers())
+				for i, frame in zip(chunk, transformed):
+					results[i] = frame.copy() # the result buffer is reused by the next stack
+		return results
+
+def loadColorMapping(mapping):
+	# a ColorMapping as is, or the name of a mapping file to load
+	if isinstance(mapping, ColorMapping):
+		return mapping
+	return ColorMapping.load(mapping)
+
+def reverseColors(frames, mapping, png=None, batch=32):
+	# generated palette colors back to the original ones; returns (frames, stats)
+	start = time.perf_counter()
+	mapping = loadColorMapping(mapping)
+	results = finishFrames(mapping.transform(toFrames(frames), batch), png)
+	return results, jobStats(start, len(results))
+
+def removeBlack(frames, png=None):
+	# true black to full transparency; returns (frames, stats)
+	start = time.perf_counter()
+	results = finishFrames([remove_black_array(np.array(frame)) for frame in toFrames(frames)], png)
+	return results, jobStats(start, len(results))
+
+def convertFrames(frames, mapping=None, transparent=True, png=None, batch=32):
+	# both steps without decoding or encoding in between, like ReverseColors then Transparent
+	start = time.perf_counter()
+	frames = toFrames(frames)
+	if mapping is not None:
+		frames = loadColorMapping(mapping).transform(frames, batch)
+	if transparent:
+		frames = [remove_black_array(frame if mapping is not None else np.array(frame)) for frame in frames]
+	results = finishFrames(frames, png)
+	return results, jobStats(start, len(results))
+
+def makeAnimation(frames, gap=1000/60, format="gif", crop=False, known=False, delta=False):
+	# one animation (gif, webp or apng) as bytes, made the same way as Gif.py; returns (data, stats).
+	# gap is in ms or any string Gif.py's --gap accepts, e.g. "50fps"; known and delta only apply to gifs
+	start = time.perf_counter()
+	if isinstance(gap, str):
+		gap = parseGap(gap)
+	images = [Image.fromarray(frame) for frame in toFrames(frames)]
+	if len(images) == 0:
+		raise ValueError("No frames to animate")
+	if crop == True:
+		images = cropFrames(images)
+	palette = None
+	if format == "gif" and known == True:
+		present = newHistogram()
+		for image in images:
+			colorHistogram(image, present)
+		palette = knownPalette(present) # None with more than 255 colors: per-frame palettes
+		if palette is not None:
+			images = [indexFrame(image, palette) for image in images]
+	output = io.BytesIO()
+	if format == "gif" and delta == True:
+		streamGif(images, gap, output, palette is not None, True)
+	else:
+		ANIMATION_WRITERS[format](images, gap, output)
+	data = output.getvalue()
+	return data, jobStats(start, len(images), bytes=len(data), size=images[0].size, knownPalette=palette is not None)
+
+def generatePalette(paletteRaw, tolerance=0, compact=False):
+	# GeneratePalette.py on the bytes of a pal_a.bin; returns ((new pal_a.bin bytes, mapping text, ColorMapping), stats)
+	import GeneratePalette # needs the Base/ modules, only loaded when palettes are generated
+	start = time.perf_counter()
+	with tempfile.TemporaryDirectory() as folder:
+		inFileName = os.path.join(folder, "in", "pal_a.bin")
+		outFileName = os.path.join(folder, "out", "pal_a.bin")
+		mappingFileName = os.path.join(folder, "out", "inversePaletteMapping.txt")
+		os.makedirs(os.path.dirname(inFileName))
+		with open(inFileName, "wb") as inFile:
+			inFile.write(paletteRaw)
+		with contextlib.redirect_stdout(io.StringIO()): # it reports every character as it goes (process-wide, keep it to one thread)
+			GeneratePalette.generatePalette(inFileName, outFileName, mappingFileName, tolerance, False, False, (), compact)
+		with open(outFileName, "rb") as outFile:
+			newPaletteRaw = outFile.read()
+		with open(mappingFileName, "r") as mappingFile:
+			mappingText = mappingFile.read()
+	mapping = ColorMapping.fromText(mappingText)
+	stats = {"seconds": time.perf_counter() - start, "tolerance": tolerance, "compact": compact, "mappingSeconds": mapping.loadSeconds}
+	return (newPaletteRaw, mappingText, mapping), stats
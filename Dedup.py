@@ -0,0 +1,24 @@
+import numpy as np
+import hashlib
+import shutil
+
+# 60 fps footage has long runs of identical frames (holds, hitstop, super freezes);
+# hash each decoded frame so a repeat can reuse the output written for its first occurrence
+
+def frameHash(data):
+	data = np.ascontiguousarray(data)
+	digest = hashlib.blake2b(str(data.shape).encode(), digest_size=16)
+	digest.update(data.data)
+	return digest.hexdigest()
+
+def reuseOutput(seen, key, outputFileName, copy=shutil.copyfile):
+	# seen maps frame hashes to the output file already written for them
+	if seen is None or key not in seen:
+		return False
+	if seen[key] != outputFileName:
+		copy(seen[key], outputFileName)
+	return True
+
+def rememberOutput(seen, key, outputFileName):
+	if seen is not None:
+		seen[key] = outputFileName
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import collections
+import os.path
+import shutil
+import zlib
+import io
+import Instrument
+
+# Pillow PNG save options; "fast" is meant for intermediate frames that get read again later
+PNG_PROFILES = {
+	"default": {}, # Pillow's defaults (zlib level 6)
+	"fast": {"compress_level": 1, "compress_type": zlib.Z_RLE},
+	"store": {"compress_level": 0},
+	"small": {"compress_level": 9, "optimize": True},
+}
+PNG_STRATEGIES = {
+	"profile": None, # keep the profile's strategy
+	"default": zlib.Z_DEFAULT_STRATEGY,
+	"filtered": zlib.Z_FILTERED,
+	"huffman": zlib.Z_HUFFMAN_ONLY,
+	"rle": zlib.Z_RLE, # long runs of the same color, e.g. a sprite on a black background
+	"fixed": zlib.Z_FIXED,
+}
+
+def writeImage(image, fileName, options=None):
+	# image.save(), split into "encode" and "disk write" stages when instrumented
+	options = options or {}
+	if not Instrument.enabled():
+		image.save(fileName, **options)
+		return
+	buffer = io.BytesIO()
+	with Instrument.stage("encode"):
+		image.save(buffer, format=Image.registered_extensions().get(os.path.splitext(fileName)[1].lower(), "PNG"), **options)
+	with Instrument.stage("disk write"):
+		with open(fileName, "wb") as imageFile:
+			imageFile.write(buffer.getbuffer())
+
+def pngOptions(profile="default", level=-1, strategy="profile"):
+	options = dict(PNG_PROFILES[profile])
+	if level >= 0:
+		options["compress_level"] = level
+	if PNG_STRATEGIES[strategy] is not None:
+		options["compress_type"] = PNG_STRATEGIES[strategy]
+	return options
+
+class EncoderPool:
+	# encodes and writes images on background threads (Pillow releases the GIL while compressing)
+	# so the caller can decode and transform the next frames in the meantime;
+	# with 0 threads every write happens immediately on the calling thread.
+	# Completion callbacks always run on the calling thread, in submission order;
+	# errors from background writes are printed and counted, close() returns that count.
+	def __init__(self, threads=0, options=None, limit=0):
+		self.threads = threads
+		self.options = options or {}
+		self.limit = limit or threads * 2
+		self.executor = ThreadPoolExecutor(threads) if threads > 0 else None
+		self.queue = collections.deque() # (future, fileName, callback) in submission order
+		self.pending = {} # fileName -> future still being written
+		self.errorCount = 0
+
+	def __getstate__(self):
+		# process pool workers get a synchronous encoder with the same options
+		return {"options": self.options}
+
+	def __setstate__(self, state):
+		self.__init__(0, state["options"])
+
+	def submit(self, work, fileName, callback):
+		if self.executor is None: # errors propagate to the caller like a plain image.save()
+			work()
+			if callback is not None:
+				callback()
+			return
+		while len(self.queue) >= self.limit: # bounded, so finished frames don't pile up in memory
+			self.finishFirst()
+		future = self.executor.submit(work)
+		self.queue.append((future, fileName, callback))
+		self.pending[fileName] = future
+		self.poll()
+
+	def save(self, image, fileName, callback=None):
+		self.submit(lambda: writeImage(image, fileName, self.options), fileName, callback)
+
+	def copy(self, sourceFileName, fileName, callback=None):
+		source = self.pending.get(sourceFileName)
+		def work():
+			if source is not None:
+				source.result() # the source file may still be being written
+			with Instrument.stage("disk write"):
+				shutil.copyfile(sourceFileName, fileName)
+		self.submit(work, fileName, callback)
+
+	def fail(self, fileName, e):
+		print("Error while writing output image file \"{}\":".format(fileName))
+		print(e)
+		self.errorCount += 1
+
+	def finishFirst(self):
+		future, fileName, callback = self.queue.popleft()
+		if self.pending.get(fileName) is future:
+			del self.pending[fileName]
+		try:
+			future.result()
+		except Exception as e:
+			self.fail(fileName, e)
+			return
+		if callback is not None:
+			callback()
+
+	def poll(self):
+		while len(self.queue) > 0 and self.queue[0][0].done():
+			self.finishFirst()
+
+	def close(self):
+		# wait for every write; returns how many background writes failed
+		while len(self.queue) > 0:
+			self.finishFirst()
+		if self.executor is not None:
+			self.executor.shutdown()
+		return self.errorCount
@@ -1,17 +1,24 @@
 import os, os.path
 import sys
 import itertools
+import functools
 import hashlib
 import time
 from datetime import datetime, timezone
-from gooey import Gooey, GooeyParser
+from Headless import Gooey, GooeyParser
 
 sys.path.insert(1, 'Base/')
 from GamePalette import PaletteColor, DEFAULT_PALETTE_LENGTH, BYTES_PER_COLOR
 from GameRoster import GameRoster, BUTTON_A, BUTTON_B, BUTTON_C, BUTTON_D, BUTTONS
+from Mapping import MAPPING_SIZE, NEAREST_DISTANCE_PREFIX, rgbaToInt32, buildMapping, saveCompiledMapping, compileMapping
+from Manifest import Manifest
+import Instrument
+import numpy as np
 
 DEFAULT_TOLERANCE = 2
-MIN_TOLERANCE, MAX_TOLERANCE = 0, 3 # any higher than this and generated colors start to conflict w/each other
+# above 3, generated colors are spaced out on a coarser grid so their tolerance ranges can't conflict w/each other;
+# the higher the tolerance, the fewer colors there are to go around
+MIN_TOLERANCE, MAX_TOLERANCE = 0, 8
 BLACK = PaletteColor(0, 0, 0, 255)
 TRANSPARENCY = PaletteColor(0, 0, 0, 0)
 # colors that should NOT appear in any generated palettes,
@@ -46,29 +53,91 @@ EXTRA_PALETTES_TO_BLANK = [
     "MAX2 Flash",
 ]
 
-def rainbowPaletteGenerator(colorsToAvoid=COLORS_TO_AVOID):
-    # generate every possible color in 02UM's RGB555 palette in an endless loop...
-    def rawGenerator():
-        initialColor = 0xFFFF
-        color = initialColor
-        outputColor = PaletteColor()
-        priorOutputColor = PaletteColor()
-        outputColor.setColorFromInt16(color)
-        priorOutputColor.setColorFromInt16(color)
-        while True:
-            yield outputColor
-            # avoid generating the exact same color twice in a row
-            while outputColor.getColorAsInt16() == priorOutputColor.getColorAsInt16():
-                color -= 1
-                outputColor.setColorFromInt16(color)
-                if color <= 0x8000:
-                    color = initialColor # loop back to the beginning
-                    raise Exception("Color generator looped back to the start!") # should never be seen
-            priorOutputColor.setColorFromARGB32(outputColor.getColorAsARGB32())
-    def colorFilter(color):
-        return any(color == colorToAvoid for colorToAvoid in colorsToAvoid)
-    # ...but skip over colors in the list of colors to avoid
-    return itertools.filterfalse(colorFilter, rawGenerator())
+def rawRainbowGenerator():
+    # generate every possible color in 02UM's RGB555 palette, once each...
+    initialColor = 0xFFFF
+    color = initialColor
+    outputColor = PaletteColor()
+    priorOutputColor = PaletteColor()
+    outputColor.setColorFromInt16(color)
+    priorOutputColor.setColorFromInt16(color)
+    while True:
+        yield outputColor
+        # avoid generating the exact same color twice in a row
+        while outputColor.getColorAsInt16() == priorOutputColor.getColorAsInt16():
+            color -= 1
+            outputColor.setColorFromInt16(color)
+            if color <= 0x8000:
+                return
+        priorOutputColor.setColorFromARGB32(outputColor.getColorAsARGB32())
+
+@functools.lru_cache(maxsize=None)
+def rainbowCandidates():
+    # ...computed once: RGB888 value and palette file bytes of each color, in generation order
+    colors, encoded = [], []
+    for color in rawRainbowGenerator():
+        colors.append(color.asRGBTuple())
+        raw = [None for i in range(BYTES_PER_COLOR)]
+        color.write(raw, 0)
+        encoded.append(bytes(raw))
+    colors = np.array(colors, dtype=np.int32).reshape(-1, 3)
+    encoded = np.frombuffer(b"".join(encoded), dtype=np.uint8).reshape(-1, BYTES_PER_COLOR)
+    return colors, encoded
+
+def avoidMask(colors, colorsToAvoid=COLORS_TO_AVOID, tolerance=0):
+    # True for colors within tolerance (per R/G/B channel) of a color to avoid,
+    # since the tolerance around a generated color must not reach those either
+    avoid = np.array([color.asRGBTuple() for color in colorsToAvoid], dtype=np.int32).reshape(-1, 3)
+    distances = np.abs(colors[:, None, :] - avoid[None, :, :]).max(axis=2)
+    return (distances <= tolerance).any(axis=1)
+
+def spacedLevels(values, spacing):
+    # smallest channel values that are at least spacing apart from each other
+    levels = []
+    for value in sorted(set(values)):
+        if len(levels) == 0 or value - levels[-1] >= spacing:
+            levels.append(value)
+    return levels
+
+def spacingMask(colors, tolerance=0):
+    # True for colors on a grid whose points are at least 2t+1 apart in some channel,
+    # so the tolerance neighbourhoods of two generated colors never overlap;
+    # up to tolerance 3 that's every RGB555 color, since expanded levels are 8 or 9 apart
+    mask = np.ones(len(colors), dtype=bool)
+    for channel in range(3):
+        mask &= np.isin(colors[:, channel], spacedLevels(colors[:, channel].tolist(), 2 * tolerance + 1))
+    return mask
+
+class PaletteSequence:
+    # palette entries sliced out of precomputed bytes, continuing where the previous segment stopped
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.position = 0
+
+    def take(self, length):
+        end = self.position + length
+        if end > len(self.encoded):
+            raise Exception("Ran out of generated colors after {}; use a lower tolerance.".format(len(self.encoded)))
+        result = self.encoded[self.position:end].tobytes()
+        self.position = end
+        return result
+
+    def skip(self, length):
+        # same colors as take() would have used, for palettes that aren't regenerated
+        self.take(length)
+
+def rainbowPaletteSequence(colorsToAvoid=COLORS_TO_AVOID, tolerance=0):
+    # every RGB555 color that is spaced out enough for the tolerance,
+    # except the ones to avoid (and their tolerance neighbourhoods)
+    colors, encoded = rainbowCandidates()
+    return PaletteSequence(encoded[spacingMask(colors, tolerance) & ~avoidMask(colors, colorsToAvoid, tolerance)])
+
+def fittingTolerance(needed, colorsToAvoid=COLORS_TO_AVOID):
+    # highest tolerance that still leaves a generated color for each of the needed palette entries (None if none does)
+    for tolerance in range(MAX_TOLERANCE, MIN_TOLERANCE - 1, -1):
+        if len(rainbowPaletteSequence(colorsToAvoid, tolerance).encoded) >= needed:
+            return tolerance
+    return None
 
 # for generating palettes with one solid color (e.g., black to make objects disappear entirely)
 def solidColorPaletteGenerator(color):
@@ -89,19 +158,105 @@ def printColorMapping(fromColor, toColor, outputRBGA=False):
         )
     return result
 
-def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0):
+def toleranceOffsets(tolerance):
+    # every (dR, dG, dB) within tolerance, in the same order as nested R, G, B loops
+    return np.array(list(itertools.product(range(-tolerance, tolerance+1), repeat=3)), dtype=np.int32).reshape(-1, 3)
+
+def expandColors(colors, tolerance):
+    # (N, 3) RGB colors -> (N, (2t+1)^3, 3) colors within tolerance of each, plus which of those are valid (0-255)
+    neighbours = np.asarray(colors, dtype=np.int32).reshape(-1, 1, 3) + toleranceOffsets(tolerance)
+    inRange = np.all((neighbours >= 0) & (neighbours <= 255), axis=2)
+    return neighbours, inRange
+
+def colorKeys(colors):
+    # same layout as rgbaToInt32(r, g, b, 0), i.e. the index into the compiled mapping
+    colors = np.asarray(colors, dtype=np.int64)
+    return (colors[..., 0] | (colors[..., 1] << 8) | (colors[..., 2] << 16)).astype(np.uint32)
+
+def newColorBitmap():
+    # one bit per RGB888 color
+    return np.zeros(MAPPING_SIZE // 8, dtype=np.uint8)
+
+def claimColors(bitmap, keys):
+    # marks keys as generated; returns the position of the first key that was already generated
+    # (earlier, or earlier in keys itself) without marking anything, or -1
+    keys = np.asarray(keys, dtype=np.uint32)
+    bits = (1 << (keys & 7)).astype(np.uint8)
+    collisions = (bitmap[keys >> 3] & bits) != 0
+    _, first = np.unique(keys, return_index=True)
+    repeated = np.ones(len(keys), dtype=bool)
+    repeated[first] = False
+    collisions |= repeated
+    if collisions.any():
+        return int(np.flatnonzero(collisions)[0])
+    np.bitwise_or.at(bitmap, keys >> 3, bits)
+    return -1
+
+def characterSegments(character, mappedOnly=False):
+    # palette segments a character gets generated colors in: A button and extra palettes (which go in
+    # the inverse mapping), then the portrait and B button palettes (solid black)
+    paletteA = character.getButtonPalette(BUTTON_A)
+    segments = [paletteA[i] for i in range(len(paletteA))]
+    for i in range(character.countExtraPalettes()):
+        extraPalette = character.getExtraPalette(i)
+        if len(extraPalette) > 0:
+            segments.append(extraPalette)
+    if not mappedOnly:
+        for portraitPalettes in character.iterPortraitPalettes():
+            segments.extend(portraitPalettes[i] for i in range(len(portraitPalettes)))
+        paletteB = character.getButtonPalette(BUTTON_B)
+        segments.extend(paletteB[i] for i in range(len(paletteB)))
+    return segments
+
+def characterHash(paletteRaw, character):
+    # SHA-1 of the input colors that end up in a character's inverse mappings
+    digest = hashlib.sha1()
+    for segment in characterSegments(character, True):
+        digest.update(paletteRaw[segment.offset:segment.offset + len(segment) * BYTES_PER_COLOR])
+    return digest.hexdigest().upper()
+
+def replaceSection(lines, sectionLines, name):
+    # swaps the "# <name>" ... "# End <name>" block in lines for the one in sectionLines
+    def bounds(source):
+        start = source.index("# " + name)
+        return start, source.index("# End " + name, start) + 1
+    start, end = bounds(lines)
+    newStart, newEnd = bounds(sectionLines)
+    lines[start:end] = sectionLines[newStart:newEnd]
+
+def replacePreambleLine(lines, prefix, line):
+    for i in range(len(lines)):
+        if lines[i].startswith(prefix):
+            lines[i] = line
+            return
+
+def countMappings(lines):
+    return sum(1 for line in lines if len(line.split("#")[0].split(":")) >= 2)
+
+def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0, compiled=False, incremental=False, names=(), compact=False):
+    # incremental: only regenerate the characters in names and the ones whose input colors changed
+    # since the last run with the same tolerance, patching the previous output files.
+    # compact: one mapping line per generated color instead of one per color within tolerance
     inverseMappingFileContent = []
+    # same mappings as the text file, kept as arrays of raw ints for writing the compiled mapping
+    mappingIndices, mappingColors = [], []
     inverseMappingFilePreamble = [
         "# Inverse palette mapping for custom pal_a.bin",
         "# Pass this file as the \"-m\" (or \"--mapping\") parameter when running the \"python ReverseColors.py\" script.",
         ""
     ]
-    allColorsGenerated = set([BLACK.asRGBTuple()])
-    rainbow = rainbowPaletteGenerator()
+    allColorsGenerated = newColorBitmap()
+    claimColors(allColorsGenerated, colorKeys([BLACK.asRGBTuple()]))
+    generatedCount = 1
+    rainbow = rainbowPaletteSequence(tolerance=tolerance)
     alwaysBlack = solidColorPaletteGenerator(BLACK)
 
     def writeColorMapping(fromColor, toColor, outputRGBA=False):
         inverseMappingFileContent.append(printColorMapping(fromColor, toColor, outputRGBA))
+        if compiled:
+            toRGBA = toColor.asRGBATuple() if outputRGBA else (*toColor.asRGBTuple(), 255)
+            mappingIndices.append(np.array([rgbaToInt32(*fromColor.asRGBTuple(), 0)], dtype=np.uint32))
+            mappingColors.append(np.array([rgbaToInt32(*toRGBA)], dtype=np.uint32))
     
     def sectionBreak(target=inverseMappingFileContent):
         target.append("")
@@ -109,6 +264,8 @@ def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0
         target.append("")
 
     def grabPaletteSegment(source, length=DEFAULT_PALETTE_LENGTH, step=BYTES_PER_COLOR):
+        if isinstance(source, PaletteSequence):
+            return source.take(length)
         result = [None for i in range(length * step)]
         index = 0
         for color in itertools.islice(source, length):
@@ -120,27 +277,37 @@ def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0
         #count = target.entryCount
         #start, end = target.offset, target.offset + (count * BYTES_PER_COLOR)
         #print("Writing {}-color palettte segment from 0x{:08X} to 0x{:08X}".format(count, start, end))
+        nonlocal generatedCount
         target.read(grabPaletteSegment(source, target.entryCount), 0)
         if oldPaletteSegment is not None:
-            for i in range(len(target)):
-                rawNewColor = target[i]
-                oldColor = oldPaletteSegment[i]
-                rawNewColorKey = rawNewColor.asRGBTuple()
-                # rawNewColor = newColor.getColorAsInt16()
-                rawR, rawG, rawB = rawNewColorKey
-                for newR in range(rawR-tolerance, rawR+tolerance+1, 1):
-                    for newG in range(rawG-tolerance, rawG+tolerance+1, 1):
-                        for newB in range(rawB-tolerance, rawB+tolerance+1, 1):
-                            if (0 <= newR <= 255) and (0 <= newG <= 255) and (0 <= newB <= 255):
-                                newColor = PaletteColor(newR, newG, newB, 255)
-                                newColorKey = newColor.asRGBTuple()
-                                if newColorKey not in allColorsGenerated:
-                                    allColorsGenerated.add(newColorKey)
-                                    writeColorMapping(newColor, oldColor)
-                                else:
-                                    raise Exception("ERROR: Color {} has already been generated earlier!".format(newColorKey))
-                                    # pass
-                if tolerance > 0:
+            # the whole segment at once: every color within tolerance of each generated color,
+            # clipped to 0-255 and checked against everything generated so far
+            count = len(target)
+            generatedColors = [target[i].asRGBTuple() for i in range(count)]
+            neighbours, inRange = expandColors(generatedColors, tolerance)
+            newColors = neighbours[inRange]
+            keys = colorKeys(newColors)
+            collision = claimColors(allColorsGenerated, keys)
+            if collision >= 0:
+                raise Exception("ERROR: Color {} has already been generated earlier!".format(tuple(newColors[collision].tolist())))
+            counts = inRange.sum(axis=1)
+            if compact: # only list the generated colors themselves, the tolerance is resolved when loading the mapping
+                newColors = np.array(generatedColors, dtype=np.int32).reshape(-1, 3)
+                keys = colorKeys(newColors)
+                counts = np.ones(count, dtype=np.int64)
+            generatedCount += len(keys)
+            oldColors = [oldPaletteSegment[i].asRGBTuple() for i in range(count)]
+            if compiled:
+                mappingIndices.append(keys)
+                mappingColors.append(np.repeat(np.array([rgbaToInt32(*oldColor) for oldColor in oldColors], dtype=np.uint32), counts))
+            # same lines as printColorMapping, built per segment
+            newColors = newColors.tolist()
+            j = 0
+            for oldColor, colorCount in zip(oldColors, counts.tolist()):
+                suffix = " : rgb({:>3}, {:>3}, {:>3})".format(*oldColor)
+                inverseMappingFileContent.extend(["rgb({:>3}, {:>3}, {:>3})".format(*newColor) + suffix for newColor in newColors[j:j+colorCount]])
+                j += colorCount
+                if tolerance > 0 and not compact:
                     inverseMappingFileContent.append("") # blank "spacer" between entries in a palette segment
         # end readPaletteSegment()
 
@@ -213,14 +380,47 @@ def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0
     # start main block of generatePalette()
     print("Reading input palette file: " + inFileName)
     print("====")
-    with open(inFileName, "rb") as inFile:
+    with Instrument.stage("palette read"), open(inFileName, "rb") as inFile:
         oldPaletteRaw = inFile.read()
         oldPalette = GameRoster(oldPaletteRaw)
         newPalette = GameRoster(oldPaletteRaw)
+    oldHash = hashlib.sha1(oldPaletteRaw).hexdigest().upper()
+    # check up front that the whole roster fits, instead of running out of colors partway through
+    needed = sum(segment.entryCount for character in oldPalette for segment in characterSegments(character, True))
+    if len(rainbow.encoded) < needed:
+        raise Exception("ERROR: Tolerance {} only leaves {} generated colors but the palettes need {}; use a tolerance of {} or lower.".format(
+            tolerance, len(rainbow.encoded), needed, fittingTolerance(needed)
+        ))
+
+    outPath = os.path.dirname(outFileName)
+    manifest = Manifest(os.path.join(outPath, "GeneratePalette.manifest.json"), {"tolerance": tolerance, "compact": compact}, not incremental)
+    characterHashes = {character.name: characterHash(oldPaletteRaw, character) for character in oldPalette}
+    previousPaletteRaw, regenerate = None, None # None: every character
+    if incremental:
+        if os.path.exists(outFileName) and os.path.exists(inverseMappingFileName):
+            with open(outFileName, "rb") as previousFile:
+                previousPaletteRaw = previousFile.read()
+        if previousPaletteRaw is None or hashlib.sha1(previousPaletteRaw).hexdigest().upper() != manifest.info.get("output"):
+            print("No previous output generated with tolerance {}, regenerating every character".format(tolerance))
+            previousPaletteRaw = None
+            manifest = Manifest(manifest.fileName, manifest.settings, True)
+        else:
+            knownNames = set(characterHashes) | set(EXTRA_PALETTES_TO_BLANK)
+            for name in names:
+                if name not in knownNames:
+                    print("WARNING: No character or extra palette named \"{}\"".format(name))
+            regenerate = set(names) | set(name for name, hash in characterHashes.items() if not manifest.isDone(name, hash))
+            if len(regenerate) == 0 and manifest.info.get("input") == oldHash:
+                print("Output palette is already up to date: " + outFileName)
+                return 0
 
     # set character palettes
-    for character in newPalette:
-        processCharacter(character, tolerance)
+    with Instrument.stage("palette generation", len(characterHashes) if regenerate is None else len(regenerate)):
+        for character in newPalette:
+            if regenerate is None or character.name in regenerate:
+                processCharacter(character, tolerance)
+            else: # keep its previous colors, but use up the same rainbow colors as a full run would
+                rainbow.skip(sum(segment.entryCount for segment in characterSegments(character, True)))
     
     # set select "extra" palettes (e.g., for special hit effects) to solid black
     # (these don't go in the inverse mapping file)
@@ -236,19 +436,25 @@ def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0
 
     newPaletteRaw = list(oldPaletteRaw)
     newPalette.write(newPaletteRaw)
+    if regenerate is not None: # patch the previous colors back in for the characters that were skipped
+        for character in newPalette:
+            if character.name not in regenerate:
+                for segment in characterSegments(character):
+                    start, end = segment.offset, segment.offset + (len(segment) * BYTES_PER_COLOR)
+                    newPaletteRaw[start:end] = previousPaletteRaw[start:end]
     newPaletteRaw = bytes(newPaletteRaw)
-    oldHash = hashlib.sha1(oldPaletteRaw).hexdigest().upper()
     newHash = hashlib.sha1(newPaletteRaw).hexdigest().upper()
     inverseMappingFilePreamble.append("# Input palette file SHA-1 hash:  " + oldHash)
     inverseMappingFilePreamble.append("# Output palette file SHA-1 hash: " + newHash)
-    inverseMappingFilePreamble.append("# This file contains {} total color mappings.".format(len(allColorsGenerated)))
+    inverseMappingFilePreamble.append("# This file contains {} total color mappings.".format(generatedCount))
     inverseMappingFilePreamble.append("# Tolerance value used when generating this file: {}".format(tolerance))
+    if compact:
+        inverseMappingFilePreamble.append(NEAREST_DISTANCE_PREFIX + str(tolerance))
 
-    outPath = os.path.dirname(outFileName)
     if not os.path.exists(outPath):
         os.makedirs(outPath)
 
-    with open(outFileName, "wb") as outFile:
+    with Instrument.stage("disk write"), open(outFileName, "wb") as outFile:
         outFile.write(newPaletteRaw)
     print("=====")
     print("Wrote output palette file to: " + outFileName)
@@ -256,10 +462,32 @@ def generatePalette(inFileName, outFileName, inverseMappingFileName, tolerance=0
     now = datetime.now(timezone.utc).strftime("%B %d, %Y, %I:%M %p UTC")
     inverseMappingFilePreamble.append("# Inverse palette mapping file generated on {}.".format(now))
     sectionBreak(inverseMappingFilePreamble)
+    if regenerate is not None: # swap the regenerated characters' sections into the previous mapping file
+        with open(inverseMappingFileName, "r") as inverseMappingFile:
+            previousContent = inverseMappingFile.read().split("\n")
+        for character in newPalette:
+            if character.name in regenerate:
+                replaceSection(previousContent, inverseMappingFileContent, character.name)
+        inverseMappingFileContent[:] = previousContent[previousContent.index("# =====") + 2:] # drop the old preamble
+        replacePreambleLine(inverseMappingFilePreamble, "# This file contains ", "# This file contains {} total color mappings.".format(countMappings(inverseMappingFileContent)))
     inverseMappingFileContent[:0] = inverseMappingFilePreamble
-    with open(inverseMappingFileName, "w") as inverseMappingFile:
+    with Instrument.stage("disk write"), open(inverseMappingFileName, "w") as inverseMappingFile:
         inverseMappingFile.write("\n".join(inverseMappingFileContent))
     print("Wrote inverse palette mapping to: " + inverseMappingFileName)
+    if compiled:
+        with Instrument.stage("mapping compile"):
+            if regenerate is None:
+                distance = tolerance if compact else 0
+                compiledFileName = saveCompiledMapping(inverseMappingFileName, buildMapping(np.concatenate(mappingIndices), np.concatenate(mappingColors), distance), distance)
+            else:
+                _, compiledFileName = compileMapping(inverseMappingFileName)
+        print("Wrote compiled inverse palette mapping to: " + compiledFileName)
+
+    for name, hash in characterHashes.items():
+        if regenerate is None or name in regenerate:
+            manifest.complete(name, hash)
+    manifest.info["input"], manifest.info["output"] = oldHash, newHash
+    manifest.save()
     return 0
     # end generatePalette()
 
@@ -295,6 +523,30 @@ def main():
             "increment": 1,
         }
     )
+    parser.add_argument("-c", "--compiled",
+        action="store_true",
+        help="Also write a compiled (memory-mappable) copy of the inverse palette mapping, so ReverseColors can skip parsing the text file."
+    )
+    parser.add_argument("-i", "--incremental",
+        action="store_true",
+        help="Only regenerate characters whose colors changed in the input palette since the last run (same tolerance), patching the existing output files."
+    )
+    parser.add_argument("-n", "--names",
+        nargs="*",
+        help="Characters to regenerate in incremental mode even if their input colors didn't change."
+    )
+    parser.add_argument("--compact",
+        action="store_true",
+        help="Write one inverse mapping line per generated color instead of one per color within tolerance. ReverseColors matches captured colors to the nearest generated color."
+    )
+    parser.add_argument("-pr", "--perf_report",
+        action="store_true",
+        help="Write a JSON performance report (time per stage, peak memory) to the output folder at the end of the run."
+    )
+    parser.add_argument("-pf", "--profile",
+        action="store_true",
+        help="Also profile the run with cProfile, saved next to the performance report."
+    )
     parser.add_argument("-d", "--default",
 		action="store_true",
 		help="Set the current values as the new default configuration.")
@@ -341,11 +593,15 @@ def main():
         print("WARNING: Input and output file paths are the same.  Output files may not overwrite the input files.  Exiting now.")
         return 1
     else:
+        if args["perf_report"] or args["profile"]:
+            outputPath = os.path.abspath(args["Output Palette Path"])
+            Instrument.start("GeneratePalette", args, os.path.join(outputPath, "GeneratePalette.report.json"), os.path.join(outputPath, "GeneratePalette.prof") if args["profile"] else None)
         start = time.perf_counter()
-        result = generatePalette(inputPaletteFileName, outputPaletteFileName, inversePaletteMappingFileName, args["Tolerance"])
+        result = generatePalette(inputPaletteFileName, outputPaletteFileName, inversePaletteMappingFileName, args["Tolerance"], args["compiled"], args["incremental"], args["names"] or (), args["compact"])
         end = time.perf_counter()
         elapsed = end - start
         print("Generated palette file and inverse color mapping in {:.3f}s".format(elapsed))
+        Instrument.finish()
         return result
 
 if __name__ == "__main__":
@@ -1,41 +1,316 @@
 import numpy as np
-from PIL import Image
+from PIL import Image, GifImagePlugin
 import os.path
 #import argparse
 import time
 import sys
 import glob
 import re
-from gooey import Gooey, GooeyParser
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from Headless import Gooey, GooeyParser
+import Instrument
 
 def number(x):
 	return float(re.findall("(\d+)",x)[-1])
 
-def gif(files, start, pause, restart, end, gap, crop, output):
-	files = files[start-1:pause] + files[restart-1:end] #indexation
-	frames = [Image.open(image) for image in files]
+def parseGap(gap): # "1000/50", "20" and "50fps" all mean 20ms between frames
+	if any("/" in x for x in gap) :
+		gap = float(gap.split("/")[0]) / float(gap.split("/")[1])
+	if "fps" in gap :
+		gap = 1000.0 / float(gap.split("fps")[0])
+	return float(gap)
+
+def normalizeSelection(count, start, pause, restart, end):
+	if end < start :
+		end = count
+	if pause == restart:
+		pause = start
+		restart = start + 1
+	return start, pause, restart, end
+
+def selectFrames(files, start, pause, restart, end):
+	return files[start-1:pause] + files[restart-1:end] #indexation
+
+def unionBbox(bbox, frame_bbox):
+	if frame_bbox is None: #fully transparent frame
+		return bbox
+	if bbox is None:
+		return frame_bbox
+	return (
+		min(bbox[0], frame_bbox[0]),
+		min(bbox[1], frame_bbox[1]),
+		max(bbox[2], frame_bbox[2]),
+		max(bbox[3], frame_bbox[3])
+	)
+
+def cropFrames(frames):
+	bbox = None
+	for frame in frames:
+		bbox = unionBbox(bbox, frame.getbbox())
+	return [frame.crop(bbox) for frame in frames]
+
+def alphaBbox(frame):
+	# the autocrop box only depends on transparency, so only the alpha band is scanned when there is one
+	if "A" in frame.getbands():
+		return frame.getchannel("A").getbbox()
+	return frame.getbbox()
+
+def filesBbox(files, present=None):
+	# autocrop box without keeping frames around: one frame decoded at a time;
+	# also fills the color histogram when one is given, so known palettes cost no extra decode
+	bbox = None
+	for file in files:
+		with Image.open(file) as frame:
+			bbox = unionBbox(bbox, alphaBbox(frame))
+			if present is not None:
+				colorHistogram(frame, present)
+	return bbox
+
+def paletteKeys(frame):
+	# convert("RGBA") would turn the frame's own palette into an rgba one, which then ends up in the gif header
+	colors = np.zeros((256, 3), dtype=np.int32)
+	palette = np.array(frame.getpalette("RGB"), dtype=np.int32).reshape(-1, 3)
+	colors[:len(palette)] = palette[:256]
+	table = (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+	transparency = frame.info.get("transparency")
+	if isinstance(transparency, int):
+		table[transparency] = -1
+	elif isinstance(transparency, bytes): #alpha per palette entry
+		alpha = np.frombuffer(transparency[:256], dtype=np.uint8)
+		table[:len(alpha)][alpha == 0] = -1
+	return table[np.asarray(frame)]
+
+def colorKeys(frame):
+	# 24-bit rgb key per pixel, -1 for fully transparent pixels (gif has no partial transparency)
+	if frame.mode == "P":
+		return paletteKeys(frame)
+	data = np.asarray(frame.convert("RGBA"))
+	keys = (data[..., 0].astype(np.int32) << 16) | (data[..., 1].astype(np.int32) << 8) | data[..., 2]
+	keys[data[..., 3] == 0] = -1
+	return keys
+
+def colorHistogram(frame, present):
+	keys = colorKeys(frame)
+	present[keys[keys >= 0]] = True
+
+def knownPalette(present):
+	# reverted frames only use a few hundred game palette colors: when they fit, one global palette
+	# holds them all exactly and the last index is the transparent one; None when they don't fit
+	colors = np.flatnonzero(present)
+	if len(colors) > 255:
+		return None
+	lut = np.zeros(len(present), dtype=np.uint8)
+	lut[colors] = np.arange(len(colors), dtype=np.uint8)
+	palette = np.zeros((256, 3), dtype=np.uint8)
+	palette[:len(colors), 0] = colors >> 16
+	palette[:len(colors), 1] = (colors >> 8) & 0xFF
+	palette[:len(colors), 2] = colors & 0xFF
+	return lut, palette.tobytes(), len(colors)
+
+def indexFrame(frame, palette):
+	# direct lut lookup instead of Pillow's per-frame quantization
+	lut, colors, transparency = palette
+	keys = colorKeys(frame)
+	indices = np.where(keys >= 0, lut[np.maximum(keys, 0)], transparency).astype(np.uint8)
+	indexed = Image.frombytes("P", frame.size, indices.tobytes())
+	indexed.putpalette(colors)
+	indexed.info["transparency"] = transparency
+	return indexed
+
+def newHistogram():
+	return np.zeros(0x1000000, dtype=bool)
+
+def sameFrame(a, b):
+	return a.size == b.size and a.mode == b.mode and a.tobytes() == b.tobytes()
+
+def mergeDuplicates(frames, gap):
+	# a run of identical frames becomes one frame shown for the whole run
+	merged, durations = [], []
+	for frame in frames:
+		if merged and sameFrame(merged[-1], frame):
+			durations[-1] += gap
+		else:
+			merged.append(frame)
+			durations.append(gap)
+	return merged, durations
+
+def saveGif(frames, gap, output):
+	if frames[0].mode == "P" and "transparency" in frames[0].info: #frames indexed with a known palette
+		# Pillow's writer starts a second header on a fully transparent indexed frame, and decoders drop every frame after it
+		streamGif(frames, gap, output, True)
+		return
+	with Instrument.stage("gif save"):
+		frames, durations = mergeDuplicates(frames, gap)
+		frames[0].save(output, format="GIF", append_images=frames[1:],
+	               save_all=True, duration=durations, disposal=2, optimize=False, loop=0) #disposal 2 to avoid trail of frames
+
+def paletteFrame(frame):
+	# same conversion Pillow's gif writer applies: adaptive palette, fully transparent color -> transparency index
+	if frame.mode in ("P", "L", "1"):
+		return frame
+	frame = frame.convert("P", palette=Image.Palette.ADAPTIVE)
+	if frame.palette.mode == "RGBA":
+		for rgba, index in frame.palette.colors.items():
+			if rgba[3] == 0:
+				frame.info["transparency"] = index
+				break
+	return frame
+
+def writeGifFrame(fp, frame, duration, first, shared=False, rect=None, disposal=2):
+	frame = paletteFrame(frame)
+	if first:
+		header, _ = GifImagePlugin.getheader(frame, None, {"loop": 0, "duration": duration})
+		fp.write(b"".join(header))
+	if rect is not None and rect != (0, 0) + frame.size:
+		frame = frame.crop(rect)
+	params = {"duration": duration, "disposal": disposal, "include_color_table": not shared} #disposal 2 to avoid trail of frames
+	if "transparency" in frame.info:
+		params["transparency"] = frame.info["transparency"]
+	fp.write(b"".join(GifImagePlugin.getdata(frame, (0, 0) if rect is None else rect[:2], **params)))
+
+def maskBbox(mask):
+	rows = np.flatnonzero(mask.any(axis=1))
+	if len(rows) == 0:
+		return None
+	columns = np.flatnonzero(mask.any(axis=0))
+	return (int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+def deltaRects(previousKeys, previousRect, keys):
+	# disposal of the previous frame and rectangle of the next one so the canvas ends up showing keys.
+	# A transparent pixel can't erase what is under it: when pixels turn transparent, the previous
+	# frame's rectangle grows to cover them and gets cleared (disposal 2), otherwise it stays (disposal 1)
+	vanished = (previousKeys >= 0) & (keys < 0)
+	disposal, canvas = 1, previousKeys
+	if vanished.any():
+		disposal = 2
+		previousRect = unionBbox(previousRect, maskBbox(vanished))
+		canvas = previousKeys.copy()
+		canvas[previousRect[1]:previousRect[3], previousRect[0]:previousRect[2]] = -1
+	rect = maskBbox(canvas != keys) or (0, 0, 1, 1) #a frame needs at least one pixel
+	return disposal, previousRect, rect
+
+@Instrument.timed("gif save")
+def streamGif(frames, gap, output, shared=False, delta=False):
+	# writes each frame as soon as the next different one shows up, so only two frames are ever held;
+	# runs of identical frames are merged the same way as in saveGif.
+	# shared: every frame uses the first frame's palette, so no local color tables are written.
+	# delta: only the rectangle that changed since the previous frame is written
+	# output is a file name or an open binary file
+	previous, duration, first = None, 0, True
+	with (open(output, "wb") if isinstance(output, (str, os.PathLike)) else contextlib.nullcontext(output)) as fp:
+		for frame in frames:
+			if previous is not None and sameFrame(previous, frame):
+				duration += gap
+				continue
+			keys = colorKeys(frame) if delta == True else None
+			rect = (0, 0) + frame.size
+			if previous is not None:
+				disposal = 2
+				if delta == True and frame.size == previous.size:
+					disposal, previousRect, rect = deltaRects(previousKeys, previousRect, keys)
+				writeGifFrame(fp, previous, duration, first, shared, previousRect, disposal)
+				first = False
+			previous, previousKeys, previousRect, duration = frame, keys, rect, gap
+		if previous is not None:
+			writeGifFrame(fp, previous, duration, first, shared, previousRect)
+		fp.write(b";") #trailer
+
+def gif(files, start, pause, restart, end, gap, crop, output, stream=False, known=False, delta=False):
+	files = selectFrames(files, start, pause, restart, end)
+	present = newHistogram() if known == True else None
+	if stream == True: #constant memory: crop box from a first pass, then load/crop/write one frame at a time
+		bbox = filesBbox(files, present) if crop == True or known == True else None
+		palette = knownPalette(present) if known == True else None
+		if known == True and palette is None:
+			print("\nMore than 255 colors, using per-frame palettes.")
+		frames = (loadFrame(image) for image in files)
+		if crop == True and bbox is not None:
+			frames = (frame.crop(bbox) for frame in frames)
+		if palette is not None:
+			frames = (indexFrame(frame, palette) for frame in frames)
+		streamGif(frames, gap, output, palette is not None, delta)
+		return
+	frames = loadFrames(files)
 	
 	if crop == True:
-		crops = []
-		bbox = None
+		frames = cropFrames(frames)
+	
+	palette = None
+	if known == True:
 		for frame in frames:
-			frame_bbox = frame.getbbox()
-			if bbox is None:
-				bbox = frame_bbox
-			else:
-				bbox = (
-					min(bbox[0], frame_bbox[0]),
-					min(bbox[1], frame_bbox[1]),
-					max(bbox[2], frame_bbox[2]),
-					max(bbox[3], frame_bbox[3])
-				)
+			colorHistogram(frame, present)
+		palette = knownPalette(present)
+		if palette is None:
+			print("\nMore than 255 colors, using per-frame palettes.")
+		else:
+			frames = [indexFrame(frame, palette) for frame in frames]
+	
+	if delta == True: #Pillow's writer can't mix disposal methods per frame
+		streamGif(frames, gap, output, palette is not None, True)
+	else:
+		saveGif(frames, gap, output)
+
+def loadFrame(file):
+	with Instrument.stage("png decode"):
+		frame = Image.open(file)
+		frame.load()
+	return frame
+
+def loadFrames(files, threads=0):
+	if threads <= 0:
+		return [loadFrame(file) for file in files]
+	with ThreadPoolExecutor(threads) as executor: #png decoding releases the GIL
+		return list(executor.map(loadFrame, files))
+
+@Instrument.timed("webp save")
+def saveWebp(frames, gap, output):
+	frames, durations = mergeDuplicates(frames, gap)
+	frames[0].save(output, format="WEBP", append_images=frames[1:],
+               save_all=True, duration=durations, lossless=True, loop=0) #full alpha and exact colors, no quantization
+
+@Instrument.timed("apng save")
+def saveApng(frames, gap, output):
+	frames, durations = mergeDuplicates(frames, gap)
+	# apng has a single PLTE for all frames; converting a copy keeps the palette frames untouched for the other formats
+	frames = [frame.copy().convert("RGBA") if frame.mode == "P" else frame for frame in frames]
+	frames[0].save(output, format="PNG", append_images=frames[1:],
+               save_all=True, duration=durations, loop=0) #Pillow only stores the changed region of each frame
+
+ANIMATION_WRITERS = {"gif": saveGif, "webp": saveWebp, "apng": saveApng}
+ANIMATION_EXTENSIONS = {"gif": ".gif", "webp": ".webp", "apng": ".apng"} #not .png, it would be picked up as a frame
+
+def animate(files, start, pause, restart, end, gap, crop, outputs, threads=0):
+	# outputs maps a format of ANIMATION_WRITERS to its file name; frames are decoded and cropped once,
+	# then every format is encoded on its own thread
+	files = selectFrames(files, start, pause, restart, end)
+	frames = loadFrames(files, threads)
+	
+	if crop == True:
+		frames = cropFrames(frames)
 		for frame in frames:
-			crop = frame.crop(bbox)
-			crops.append(crop)
-		frames = crops
-		
-	frames[0].save(output, format="GIF", append_images=frames[1:],
-               save_all=True, duration=gap, disposal=2, optimize=False, loop=0) #disposal 2 to avoid trail of frames
+			frame.load() #crops are lazy, don't let the encoder threads race on them
+	
+	if threads <= 0 or len(outputs) == 1:
+		for format, output in outputs.items():
+			ANIMATION_WRITERS[format](frames, gap, output)
+		return
+	with ThreadPoolExecutor(min(threads, len(outputs))) as executor:
+		# Pillow keeps encoder settings on the image objects, so every other format gets its own copies
+		futures = [executor.submit(ANIMATION_WRITERS[format], frames if i == 0 else [frame.copy() for frame in frames], gap, output)
+			for i, (format, output) in enumerate(outputs.items())]
+		for future in futures:
+			future.result()
+
+def uniqueOutput(out, name, extension):
+	new = name + extension
+	output = os.path.join(out, new)
+	j=2
+	while os.path.exists(output):
+		new = name + f"#{j}" + extension
+		output = os.path.join(out, new)
+		j+=1
+	return new, output
 
 @Gooey(program_description="Makes a customized gif out of png files. Will reset on completion for rapid usage.", tabbed_groups=True)
 def main():
@@ -84,6 +359,32 @@ def main():
 	gif_group.add_argument("-c", "--crop",
 		action="store_true",
 		help="Autocrops transparency before making the gif.")
+	gif_group.add_argument("-lm", "--low_memory",
+		action="store_true",
+		help="Write the gif one frame at a time instead of loading every frame first. Memory use stays flat on long clips.")
+	gif_group.add_argument("-kp", "--known_palette",
+		action="store_true",
+		help="Build one exact palette from the colors in the frames instead of quantizing each frame. Falls back when there are more than 255 colors.")
+	gif_group.add_argument("-dr", "--delta",
+		action="store_true",
+		help="Only store the rectangle that changed since the previous frame. Much smaller gifs when the background is still.")
+	gif_group.add_argument("-fm", "--formats",
+		nargs="+",
+		choices=["gif", "webp", "apng"],
+		default=["gif"],
+		help="Animation formats to make from the same frames. Webp is lossless, webp and apng keep full transparency.",
+		widget="Listbox")
+	gif_group.add_argument("-t", "--threads",
+		type=int,
+		default=4,
+		help="Threads used to decode the frames and to encode the formats side by side. 0 does everything in order.",
+		widget="IntegerField")
+	gif_group.add_argument("-pr", "--perf_report",
+		action="store_true",
+		help="Write a JSON performance report (time per stage, frames per second, peak memory) to the output folder at the end of the run.")
+	gif_group.add_argument("-pf", "--profile",
+		action="store_true",
+		help="Also profile the run with cProfile, saved next to the performance report.")
 		
 	output_group = parser.add_argument_group(
 		"Output",
@@ -110,21 +411,16 @@ def main():
 	gap = args["gap"]
 	default=args["default"]
 	
-	if any("/" in x for x in gap) :
-		gap = float(gap.split("/")[0]) / float(gap.split("/")[1])
-	if "fps" in gap :
-		gap = 1000.0 / float(gap.split("fps")[0])
-	gap = float(gap)
+	gap = parseGap(gap)
 	crop = args["crop"]
 	name = args["name"]
-	new = name + ".gif"
+	formats = args["formats"]
+	threads = args["threads"]
 	out = os.path.abspath(args["outputFolder"])
-	output = os.path.join(out, new)
-	j=2
-	while os.path.exists(output):
-		new = name + f"#{j}.gif"
-		output = os.path.join(out, new)
-		j+=1
+	outputs, names = {}, []
+	for format in formats:
+		new, outputs[format] = uniqueOutput(out, name, ANIMATION_EXTENSIONS[format])
+		names.append(new)
 	
 	files = sorted(glob.glob(f"{folder}/*.png"), key=number) #sorts the files by frame#number
 	
@@ -132,27 +428,30 @@ def main():
 		print("\nNo png files found in ",folder,"\n")
 		exit()
 	
-	if end < start :
-		end = len(files)
-	if pause == restart:
-		pause = start
-		restart = start + 1
+	start, pause, restart, end = normalizeSelection(len(files), start, pause, restart, end)
 		
+	if args["perf_report"] or args["profile"]:
+		Instrument.start("Gif", args, os.path.join(out, "Gif.report.json"), os.path.join(out, "Gif.prof") if args["profile"] else None)
 	go = time.perf_counter()
 			
-	gif(files, start, pause, restart, end, gap, crop, output)
+	if "gif" in outputs and (args["low_memory"] or args["known_palette"] or args["delta"]): #gif specific writers
+		gif(files, start, pause, restart, end, gap, crop, outputs.pop("gif"), args["low_memory"], args["known_palette"], args["delta"])
+	if len(outputs) > 0:
+		animate(files, start, pause, restart, end, gap, crop, outputs, threads)
 	
 	count = (pause - start + 1) + (end - restart + 1)
 	stop = time.perf_counter()
 	elapsed = stop - go
-	print("\nGathered {} image file(s) into {} in {:.3f}s".format(count, new, elapsed))
+	print("\nGathered {} image file(s) into {} in {:.3f}s".format(count, ", ".join(names), elapsed))
+	Instrument.countFrames(count)
+	Instrument.finish()
     
 	if default == True:
 		folder = repr(folder) #Convert quotes into double quotes so the address is written later with quotes + deal with escape characters
 		gap = repr(args["gap"])
 		name = repr(args["name"])
 		output = repr(args["outputFolder"])
-		data=[folder, start, pause, restart, end, gap, name, output]
+		data=[folder, start, pause, restart, end, gap, repr(formats), threads, name, output]
 		j=0
 		with open("Gif.py","r") as e:
 			new = e.read().splitlines(True) #Grab each line and keep the \n endline character
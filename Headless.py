@@ -0,0 +1,54 @@
+import argparse
+import functools
+import sys
+
+# stand-ins for gooey's Gooey and GooeyParser that only import gooey (and wx) once the GUI is actually shown.
+# With --headless, or gooey's own --ignore-gooey (which gooey passes when it runs the script from its form),
+# main() runs straight away on plain argparse, with the same options.
+
+HEADLESS_FLAGS = ("--headless", "--ignore-gooey")
+GUI_OPTIONS = ("widget", "gooey_options") # GooeyParser-only keywords
+
+headless = False
+description = None # the program_description given to Gooey, reused as the --help text
+
+def isHeadless():
+	return any(flag in sys.argv for flag in HEADLESS_FLAGS)
+
+def Gooey(function=None, **options):
+	# @Gooey(...) (or bare @Gooey) like gooey's decorator
+	def decorate(main):
+		@functools.wraps(main)
+		def wrapper(*args, **kwargs):
+			global headless, description
+			if isHeadless():
+				sys.argv = [arg for arg in sys.argv if arg not in HEADLESS_FLAGS]
+				headless, description = True, options.get("program_description")
+				return main(*args, **kwargs)
+			from gooey import Gooey
+			return Gooey(**options)(main)(*args, **kwargs)
+		return wrapper
+	if function is not None:
+		return decorate(function)
+	return decorate
+
+def withoutGuiOptions(kwargs):
+	return {key: value for key, value in kwargs.items() if key not in GUI_OPTIONS}
+
+class HeadlessParser(argparse.ArgumentParser):
+	# accepts (and drops) the GooeyParser widget options, everywhere they can be given
+	def add_argument(self, *args, **kwargs):
+		return super().add_argument(*args, **withoutGuiOptions(kwargs))
+
+	def add_argument_group(self, *args, **kwargs):
+		group = super().add_argument_group(*args, **withoutGuiOptions(kwargs))
+		addArgument = group.add_argument
+		group.add_argument = lambda *args, **kwargs: addArgument(*args, **withoutGuiOptions(kwargs))
+		return group
+
+def GooeyParser(**kwargs):
+	if headless:
+		kwargs.setdefault("description", description)
+		return HeadlessParser(**kwargs)
+	from gooey import GooeyParser
+	return GooeyParser(**kwargs)
@@ -0,0 +1,167 @@
+import os.path
+import sys
+import json
+import time
+import atexit
+import cProfile
+import platform
+import threading
+import functools
+import contextlib
+from datetime import datetime, timezone
+try:
+	import resource # peak resident memory, not on Windows
+except ImportError:
+	resource = None
+	import tracemalloc
+
+# time per stage (video decode, png decode, mapping load, lut transform, remove_black, encode, disk write, gif save...)
+# shared by the scripts. Nothing is recorded, and stage() costs next to nothing, until a script calls start().
+# Stage times are summed over every thread (and worker process), so with encoder threads they can add up
+# to more than the wall time; a streamed stage that decodes its own input also includes that decoding.
+
+recorder = None
+
+class Recorder:
+	def __init__(self, script="", settings=None, reportFileName=None, profileFileName=None):
+		self.script = script
+		self.settings = settings or {}
+		self.reportFileName = reportFileName
+		self.profileFileName = profileFileName
+		self.stages = {} # name -> [seconds, calls, items]
+		self.frames = 0
+		self.lock = threading.Lock()
+		self.start = time.perf_counter()
+		self.date = datetime.now(timezone.utc).isoformat(timespec="seconds")
+		self.profiler = None
+
+	def add(self, name, seconds, calls=1, items=1):
+		with self.lock:
+			totals = self.stages.setdefault(name, [0.0, 0, 0])
+			totals[0] += seconds
+			totals[1] += calls
+			totals[2] += items
+
+	def take(self):
+		# the stage totals so far, reset; a worker process hands these back with each result
+		with self.lock:
+			stages, self.stages = self.stages, {}
+		return stages
+
+def enabled():
+	return recorder is not None
+
+def start(script, settings=None, reportFileName=None, profileFileName=None):
+	# record from now on; the report (and profile) are written by finish(), or at exit if the script stops early
+	global recorder
+	recorder = Recorder(script, settings, reportFileName, profileFileName)
+	if resource is None:
+		tracemalloc.start()
+	if profileFileName:
+		recorder.profiler = cProfile.Profile() # only sees the calling thread
+		recorder.profiler.enable()
+	atexit.register(finish)
+	return recorder
+
+def startWorker():
+	# in a worker process: only stage totals, collected with take()
+	global recorder
+	recorder = Recorder()
+
+@contextlib.contextmanager
+def timing(name, items):
+	begin = time.perf_counter()
+	try:
+		yield
+	finally:
+		if recorder is not None:
+			recorder.add(name, time.perf_counter() - begin, 1, items)
+
+def stage(name, items=1):
+	# with stage("png decode"): ...
+	if recorder is None:
+		return contextlib.nullcontext()
+	return timing(name, items)
+
+def timed(name):
+	# decorator version of stage() for functions that are a stage as a whole
+	def decorate(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with stage(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
+
+def countFrames(count):
+	if recorder is not None:
+		with recorder.lock:
+			recorder.frames += count
+
+def take():
+	return recorder.take() if recorder is not None else None
+
+def merge(stages):
+	# adds the totals from a worker's take()
+	if recorder is None or not stages:
+		return
+	for name, (seconds, calls, items) in stages.items():
+		recorder.add(name, seconds, calls, items)
+
+def peakMemory():
+	if resource is None:
+		_, peak = tracemalloc.get_traced_memory()
+		return {"peak_traced_mb": peak / 2**20} # Python and numpy allocations only
+	scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is in bytes on macOS, kilobytes on Linux
+	return {
+		"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20,
+		"peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20, # largest worker process
+	}
+
+def report():
+	wall = time.perf_counter() - recorder.start
+	stages = {name: {
+			"seconds": seconds,
+			"calls": calls,
+			"items": items,
+			"share": seconds / wall if wall > 0 else 0,
+		} for name, (seconds, calls, items) in sorted(recorder.stages.items(), key=lambda stage: -stage[1][0])}
+	return {
+		"script": recorder.script,
+		"date": recorder.date,
+		"settings": recorder.settings,
+		"wall_seconds": wall,
+		"frames": recorder.frames,
+		"fps": recorder.frames / wall if wall > 0 else 0,
+		"stages": stages,
+		"memory": peakMemory(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+	}
+
+def finish():
+	# writes the report and profile; returns the report, or None when not recording
+	global recorder
+	if recorder is None or recorder.reportFileName is None:
+		return None
+	if recorder.profiler is not None:
+		recorder.profiler.disable()
+	result = report()
+	print("\n{:<20} {:>10} {:>8} {:>8}".format("stage", "time", "calls", "share"))
+	for name, totals in result["stages"].items():
+		print("{:<20} {:>9.3f}s {:>8} {:>7.1f}%".format(name, totals["seconds"], totals["calls"], 100 * totals["share"]))
+	if result["frames"] > 0:
+		print("{} frame(s) in {:.3f}s ({:.1f} fps)".format(result["frames"], result["wall_seconds"], result["fps"]))
+	folder = os.path.dirname(recorder.reportFileName)
+	if folder and not os.path.isdir(folder):
+		os.makedirs(folder)
+	with open(recorder.reportFileName, "w") as reportFile:
+		json.dump(result, reportFile, indent=1)
+	print("Wrote performance report to \"{}\"".format(recorder.reportFileName))
+	if recorder.profiler is not None:
+		recorder.profiler.dump_stats(recorder.profileFileName)
+		print("Wrote profile to \"{}\" (open with python -m pstats)".format(recorder.profileFileName))
+	if resource is None:
+		tracemalloc.stop()
+	recorder = None
+	return result
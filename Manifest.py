@@ -0,0 +1,65 @@
+import json
+import os
+import os.path
+
+# a job manifest remembers which work items finished under which settings,
+# so a re-run only redoes what is missing or out of date
+
+def fileStamp(fileName):
+	stat = os.stat(fileName)
+	return [stat.st_size, stat.st_mtime_ns]
+
+class Manifest:
+	def __init__(self, fileName, settings, fresh=False, saveEvery=100):
+		self.fileName = fileName
+		self.settings = settings
+		self.saveEvery = saveEvery
+		self.unsaved = 0
+		self.skipped = 0
+		self.info = {}
+		self.done = {}
+		if fresh or not os.path.exists(fileName):
+			return
+		try:
+			with open(fileName, "r") as manifestFile:
+				data = json.load(manifestFile)
+		except (OSError, ValueError):
+			return
+		if data.get("settings") == settings: # different settings means nothing can be reused
+			self.info = data.get("info", {})
+			self.done = data.get("done", {})
+
+	def __len__(self):
+		return len(self.done)
+
+	def isDone(self, key, value=True):
+		return key in self.done and self.done[key] == value
+
+	def complete(self, key, value=True):
+		self.done[key] = value
+		self.unsaved += 1
+		if self.unsaved >= self.saveEvery:
+			self.save()
+
+	def completeFile(self, inputFileName, outputFileName):
+		# output files are up to date as long as their input file hasn't changed
+		self.complete(outputFileName, fileStamp(inputFileName))
+
+	def isFileDone(self, inputFileName, outputFileName):
+		return os.path.exists(outputFileName) and self.isDone(outputFileName, fileStamp(inputFileName))
+
+	def pendingFiles(self, jobs):
+		# lazily drops the (inputFileName, outputFileName) jobs that are already up to date
+		self.skipped = 0
+		for job in jobs:
+			if self.isFileDone(*job):
+				self.skipped += 1
+			else:
+				yield job
+
+	def save(self):
+		temporaryFileName = self.fileName + ".tmp"
+		with open(temporaryFileName, "w") as manifestFile:
+			json.dump({"settings": self.settings, "info": self.info, "done": self.done}, manifestFile)
+		os.replace(temporaryFileName, self.fileName)
+		self.unsaved = 0
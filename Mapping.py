@@ -0,0 +1,150 @@
+import numpy as np
+from PIL import ImageColor
+import os.path
+import hashlib
+import time
+import glob
+import Instrument
+
+MAPPING_SIZE = 0x1000000 # one entry per possible RGB888 color
+COMPILED_MAPPING_EXTENSION = ".npy"
+# compact mapping files list each generated color once; captured colors are matched to the nearest one within this distance
+NEAREST_DISTANCE_PREFIX = "# Nearest color distance: "
+
+def rgbaToInt32(r, g, b, a=255):
+    r = (r & 0xFF) << 0
+    g = (g & 0xFF) << 8
+    b = (b & 0xFF) << 16
+    a = (a & 0xFF) << 24
+    result = (r | g | b | a)
+    return result
+
+def hashMappingFile(mappingFileName):
+    with open(mappingFileName, "rb") as mappingFile:
+        result = hashlib.sha1(mappingFile.read()).hexdigest().upper()
+    return result
+
+def mappingKey(mappingFileName, distance=0):
+    mappingHash = hashMappingFile(mappingFileName)
+    if distance > 0: # the lut of a compact mapping also depends on the distance it was built with
+        mappingHash = hashlib.sha1("{}:{}".format(mappingHash, distance).encode()).hexdigest().upper()
+    return mappingHash
+
+def mappingDistance(lines):
+    # distance declared by a compact mapping, 0 for a mapping that lists every color
+    for line in lines:
+        if line.startswith(NEAREST_DISTANCE_PREFIX):
+            return int(line[len(NEAREST_DISTANCE_PREFIX):])
+        if len(line.split("#")[0].split(":")) >= 2: # the header is over
+            break
+    return 0
+
+def readMappingDistance(mappingFileName):
+    with open(mappingFileName, "r") as mappingFile:
+        return mappingDistance(mappingFile)
+
+def compiledMappingFileName(mappingFileName, mappingHash):
+    # e.g. "inversePaletteMapping.txt" -> "inversePaletteMapping.0123456789ABCDEF.npy"
+    base, _ = os.path.splitext(mappingFileName)
+    return "{}.{}{}".format(base, mappingHash[:16], COMPILED_MAPPING_EXTENSION)
+
+def parseMappingFile(mappingFileName):
+    with open(mappingFileName, "r") as mappingFile:
+        return parseMappingLines(mappingFile.read().splitlines())
+
+def parseMappingLines(lines):
+    lines = filter(lambda line: len(line) == 2, [line.split("#")[0].split(":")[:2] for line in lines])
+    pairs = [tuple(map(lambda x: ImageColor.getrgb(x.strip()), line)) for line in lines]
+    indices = np.array([rgbaToInt32(*oldColor[:3], 0) for oldColor, _ in pairs], dtype=np.uint32)
+    newColors = np.array([rgbaToInt32(*newColor) for _, newColor in pairs], dtype=np.uint32)
+    return indices, newColors
+
+def nearestOffsets(distance):
+    # (dR, dG, dB) within distance on every channel, nearest first (per channel, then overall)
+    steps = np.arange(-distance, distance+1, dtype=np.int32)
+    offsets = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), axis=-1).reshape(-1, 3)
+    order = np.lexsort(((offsets ** 2).sum(axis=1), np.abs(offsets).max(axis=1)))
+    return offsets[order]
+
+def buildMapping(indices, newColors, distance=0):
+    # fill in color mapping with all values set to full alpha (opaque)
+    mapping = np.arange(0xFF000000, 0xFFFFFFFF+1, 1, dtype=np.uint32)
+    indices = np.asarray(indices, dtype=np.uint32)
+    newColors = np.asarray(newColors, dtype=np.uint32)
+    if distance <= 0:
+        mapping[indices] = newColors
+        return mapping
+    # compact mapping: every color within distance takes the new color of the nearest listed color,
+    # filled outwards one offset at a time so nearer colors claim each entry first
+    assigned = np.zeros(MAPPING_SIZE, dtype=bool)
+    channels = np.stack([indices & 0xFF, (indices >> 8) & 0xFF, (indices >> 16) & 0xFF], axis=1).astype(np.int32)
+    for offset in nearestOffsets(distance):
+        neighbours = channels + offset
+        valid = np.all((neighbours >= 0) & (neighbours <= 255), axis=1)
+        keys = (neighbours[valid, 0] | (neighbours[valid, 1] << 8) | (neighbours[valid, 2] << 16)).astype(np.uint32)
+        free = ~assigned[keys]
+        mapping[keys[free]] = newColors[valid][free]
+        assigned[keys[free]] = True
+    return mapping
+
+def saveCompiledMapping(mappingFileName, mapping, distance=0):
+    # the compiled file is keyed by the SHA-1 of the text mapping it was built from,
+    # so editing or regenerating the text file automatically invalidates it
+    mappingHash = mappingKey(mappingFileName, distance)
+    compiledFileName = compiledMappingFileName(mappingFileName, mappingHash)
+    base, _ = os.path.splitext(mappingFileName)
+    for staleFileName in glob.glob(glob.escape(base) + ".*" + COMPILED_MAPPING_EXTENSION):
+        if staleFileName != compiledFileName:
+            try:
+                os.remove(staleFileName)
+            except OSError: # still memory-mapped by another process
+                pass
+    temporaryFileName = compiledFileName + ".tmp"
+    with open(temporaryFileName, "wb") as compiledFile:
+        np.save(compiledFile, np.asarray(mapping, dtype=np.uint32))
+    os.replace(temporaryFileName, compiledFileName)
+    return compiledFileName
+
+def compileMapping(mappingFileName, distance=None):
+    if distance is None:
+        distance = readMappingDistance(mappingFileName)
+    indices, newColors = parseMappingFile(mappingFileName)
+    mapping = buildMapping(indices, newColors, distance)
+    compiledFileName = saveCompiledMapping(mappingFileName, mapping, distance)
+    return mapping, compiledFileName
+
+def loadCompiledMapping(mappingFileName, distance=0):
+    compiledFileName = compiledMappingFileName(mappingFileName, mappingKey(mappingFileName, distance))
+    if not os.path.exists(compiledFileName):
+        return None
+    mapping = np.load(compiledFileName, mmap_mode="r")
+    if mapping.shape != (MAPPING_SIZE,) or mapping.dtype != np.uint32:
+        return None
+    return mapping
+
+@Instrument.timed("mapping load")
+def loadMappingFromFile(mappingFileName, compiled=True, distance=None):
+    # distance: how far captured colors may be from those listed in a compact mapping (None: as declared in the file)
+    start = time.perf_counter()
+    if distance is None:
+        distance = readMappingDistance(mappingFileName)
+    if compiled:
+        mapping = loadCompiledMapping(mappingFileName, distance)
+        if mapping is not None:
+            end = time.perf_counter()
+            elapsed = end - start
+            print("Loaded compiled inverse color mapping in {:.3f}s".format(elapsed))
+            return mapping
+    indices, newColors = parseMappingFile(mappingFileName)
+    mapping = buildMapping(indices, newColors, distance)
+    if compiled:
+        try:
+            compiledFileName = saveCompiledMapping(mappingFileName, mapping, distance)
+            print("Wrote compiled inverse color mapping to \"{}\"".format(compiledFileName))
+        except OSError as e:
+            print("Could not write compiled inverse color mapping:")
+            print(e)
+    end = time.perf_counter()
+    elapsed = end - start
+    print("Loaded inverse color mapping with {} entries in {:.3f}s".format(len(indices), elapsed))
+    return mapping
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import os
+
+# decode -> transform -> write, overlapped: reader threads decode ahead of the caller's
+# transform, and an EncoderPool (see Encode.py) writes behind it; both are bounded
+
+def iterImageFiles(folder, extension=".png"):
+	# stand-in for glob.glob(os.path.join(folder, "*.png")): only the names are listed up front, a cheap snapshot
+	# (so outputs written into the same folder are never picked up); decoding and every later step stay lazy
+	if not os.path.isdir(folder): # like glob, a missing folder simply has no files
+		return iter(())
+	with os.scandir(folder) as entries:
+		paths = sorted(entry.path for entry in entries
+			if not entry.name.startswith(".") # glob's "*" skips hidden files too
+			and entry.name.lower().endswith(extension) and entry.is_file())
+	return iter(paths)
+
+def readAhead(jobs, load, readers=2, depth=8):
+	# yields (job, future of load(inputFileName)) in job order, with at most depth decodes in flight
+	with ThreadPoolExecutor(readers) as executor:
+		window = collections.deque()
+		for job in jobs:
+			window.append((job, executor.submit(load, job[0])))
+			if len(window) >= depth:
+				yield window.popleft()
+		while len(window) > 0:
+			yield window.popleft()
+
+def runPipeline(jobs, load, process, readers=2, depth=8):
+	# jobs may be a lazy iterable of (inputFileName, outputFileName);
+	# process(sourceImage, inputFileName, outputFileName) transforms and hands the result to an encoder
+	imagesProcessedCount, errorCount = 0, 0
+	for (inputFileName, outputFileName), future in readAhead(jobs, load, readers, max(depth, 1)):
+		print("")
+		try:
+			print("Processing image file \"{}\"...".format(inputFileName))
+			process(future.result(), inputFileName, outputFileName)
+			imagesProcessedCount += 1
+		except Exception as e:
+			print("Error while processing image file \"{}\":".format(inputFileName))
+			print(e)
+			errorCount += 1
+	return imagesProcessedCount, errorCount
@@ -1,13 +1,106 @@
 import os
+import re
 import glob
 import sys
+import time
+import shlex
+import shutil
+import signal
 import subprocess
-from gooey import Gooey, GooeyParser
+from concurrent.futures import ThreadPoolExecutor
+from Headless import Gooey, GooeyParser
+
+# segmented recording: ffmpeg (or any capture command) writes rolling fixed-length segments,
+# and each one is handed to frame extraction and reversal as soon as the next one starts
+SEGMENT_EXTENSION = ".mkv" # still readable if the capture is killed mid-segment
+LOSSLESS = "-c:v libx264rgb -crf 0 -preset ultrafast" # exact RGB, the generated palette colors must survive
+SEGMENT_OUTPUT = " -force_key_frames \"expr:gte(t,n_forced*{segment})\" -f segment -segment_time {segment} -reset_timestamps 1 \"{output}\""
+CAPTURE_COMMANDS = {
+	"screen": ("{ffmpeg} -hide_banner -loglevel error -f gdigrab -framerate {fps} -offset_x {left} -offset_y {top} -video_size {width}x{height} -i desktop {limit} "
+		if sys.platform == "win32" else
+		"{ffmpeg} -hide_banner -loglevel error -f x11grab -framerate {fps} -video_size {width}x{height} -i :0.0+{left},{top} {limit} ") + LOSSLESS + SEGMENT_OUTPUT,
+	"test": "{ffmpeg} -hide_banner -loglevel error -re -f lavfi -i testsrc=size={width}x{height}:rate={fps} {limit} " + LOSSLESS + SEGMENT_OUTPUT, # stands in for the screen
+}
+
+def ffmpegPath():
+	found = shutil.which("ffmpeg")
+	if found is None:
+		import imageio_ffmpeg # the copy moviepy uses
+		found = imageio_ffmpeg.get_ffmpeg_exe()
+	return found
+
+def captureCommand(capture, values):
+	# capture is a CAPTURE_COMMANDS name or a full command line using the same {placeholders}
+	template = CAPTURE_COMMANDS.get(capture, capture)
+	if "{ffmpeg}" in template: # only looked up when used, a custom command may not need ffmpeg at all
+		values = dict(values, ffmpeg=ffmpegPath())
+	command = template.format(**values)
+	return command if sys.platform == "win32" else shlex.split(command)
+
+def segmentNumber(fileName):
+	found = re.search(r"(\d+)$", os.path.splitext(fileName)[0])
+	return int(found.group(1)) if found else -1
+
+def completedSegments(base, running):
+	# the capture opens the next segment once the previous one is complete, so only the newest may still be written
+	segments = sorted(glob.glob(glob.escape(base) + "_*" + SEGMENT_EXTENSION), key=segmentNumber)
+	return segments[:-1] if running else segments
+
+def recordSegments(command, base, process, workers=1, interval=0.5):
+	# runs the capture and hands every completed segment to process() on a worker thread while it goes on;
+	# returns (segments recorded, frames processed, errors)
+	try:
+		capture = subprocess.Popen(command)
+	except OSError as e:
+		print("\nCould not start the capture command: {}".format(command))
+		print(e)
+		return 0, 0, 1
+	handed, futures = set(), []
+	frameCount, errorCount = 0, 0
+	def report(finished):
+		nonlocal frameCount, errorCount
+		for segment, future in finished:
+			futures.remove((segment, future))
+			try:
+				count = future.result()
+				frameCount += count
+				print("Processed segment \"{}\" into {} image file(s)".format(segment, count))
+			except Exception as e:
+				print("Error while processing segment \"{}\":".format(segment))
+				print(e)
+				errorCount += 1
+	with ThreadPoolExecutor(max(1, workers)) as executor:
+		while True:
+			try:
+				report([(segment, future) for segment, future in futures if future.done()])
+				running = capture.poll() is None
+				for segment in completedSegments(base, running):
+					if segment not in handed:
+						handed.add(segment)
+						print("\nRecorded segment \"{}\"".format(segment))
+						futures.append((segment, executor.submit(process, segment)))
+				if not running:
+					break
+				time.sleep(interval)
+			except KeyboardInterrupt: # ffmpeg closes its last segment properly on Ctrl+C
+				print("\nStopping the capture...")
+				if sys.platform != "win32": # on Windows it gets the console's Ctrl+C itself
+					capture.send_signal(signal.SIGINT)
+				try:
+					capture.wait(10)
+				except subprocess.TimeoutExpired:
+					capture.terminate()
+		for segment, future in list(futures): # the last ones, after the capture ended
+			future.exception()
+			report([(segment, future)])
+	if capture.returncode not in (0, None) and len(handed) == 0:
+		print("\nThe capture command failed (exit code {}): {}".format(capture.returncode, command))
+	return len(handed), frameCount, errorCount
 
 @Gooey(program_description="Records the upper left 640x448 portion of the screen where the game's window should be.", tabbed_groups=True)
 def main():
 	
-	ProgramFiles = os.path.abspath(os.environ["ProgramW6432"])
+	ProgramFiles = os.path.abspath(os.environ.get("ProgramW6432", os.environ.get("ProgramFiles", "")))
 	VLCpath = "VideoLAN\VLC\\vlc.exe"
 	cwd = os.path.abspath(os.getcwd())
 	defaultRecordPath = "Videos"
@@ -18,8 +111,9 @@ def main():
 		"Pick the program. Only VLC is confirmed to work as of now.",
 		gooey_options={'columns':1})
 	app_group.add_argument("VLC",
+		nargs="?", # not needed for segmented recording
 		default=os.path.join(ProgramFiles, VLCpath),
-		help="Path to VLC's exe file.",
+		help="Path to VLC's exe file. Only used when recording a single file with VLC.",
 		widget="FileChooser")
 	app_group.add_argument("-i", "--inp",
 		default=os.path.join(os.path.expanduser("~"), "Videos"),
@@ -58,6 +152,19 @@ def main():
 		default=60.0,
 		help="Number of frames per second to capture. Should match the game's framerate.",
 		widget="DecimalField")
+	capture_group.add_argument("-sg", "--segment",
+		type=float,
+		default=0,
+		help="Length in seconds of each recording segment. Put 0 to record a single file with VLC. Otherwise the capture command writes rolling segments that are processed while recording goes on.",
+		widget="DecimalField")
+	capture_group.add_argument("-c", "--capture",
+		default="screen",
+		help="Capture command for segmented recording: 'screen' (ffmpeg), 'test' (an ffmpeg test pattern) or a full command line using {ffmpeg}, {fps}, {top}, {left}, {width}, {height}, {segment}, {limit} and {output} (the segment file pattern).")
+	capture_group.add_argument("-du", "--duration",
+		type=float,
+		default=0,
+		help="Stop segmented recording after this many seconds. Put 0 to record until the capture is closed.",
+		widget="DecimalField")
 		
 	output_group = parser.add_argument_group(
 		"Output",
@@ -73,6 +180,27 @@ def main():
 	output_group.add_argument("-d", "--default",
 		action="store_true",
 		help="Set the current values as the new default configuration.")
+
+	process_group = parser.add_argument_group(
+		"Processing",
+		"What segmented recording does with each segment while the next one is recorded.",
+		gooey_options={'columns':1})
+	process_group.add_argument("-m", "--mapping",
+		default="",
+		help="Name/path of the inverse palette mapping file to revert the frames with. Leave empty to only extract them.",
+		widget="FileChooser")
+	process_group.add_argument("-tr", "--transparent",
+		action="store_true",
+		help="Also change true black into full transparency.")
+	process_group.add_argument("-fo", "--frames_out",
+		default="",
+		help="Folder to store the frames of every segment in. Defaults to a 'frames' folder next to the recording.",
+		widget="DirChooser")
+	process_group.add_argument("-j", "--workers",
+		type=int,
+		default=1,
+		help="Number of segments processed at the same time.",
+		widget="IntegerField")
 		
 	args = vars(parser.parse_args()) # convert parsed arguments into dict
 	VLC = args["VLC"]
@@ -84,44 +212,45 @@ def main():
 	inp = os.path.abspath(args["inp"])
 	out = os.path.abspath(args["out"])
 	name = args["name"]
+	segment = str(args["segment"])
+	capture = args["capture"]
+	duration = str(args["duration"])
+	mapping = args["mapping"]
+	frames_out = args["frames_out"]
+	workers = str(args["workers"])
 	default = args["default"]
 	
 	if not os.path.exists(out):
 		os.makedirs(out)
 		print("\nCreated record directory \"{}\"".format(out))
 
-	path = os.path.join(inp, "*.avi")
-	before = len(glob.glob(path))
-
-	command = VLC+" screen:// :screen-fps="+fps+" :live-caching=300 :screen-top="+top+" :screen-left="+left+" :screen-width="+width+" :screen-height="+height
-	subprocess.call(command)
-
-	new = name + ".avi"
-	output = os.path.join(out, new)
-	j=2
-    
-	path = os.path.join(inp, "*.avi")
-	files = sorted(glob.glob(path), key=os.path.getmtime, reverse=True) #Sorts avi files by latest modification
-	after = len(files)
-	number = after - before
-	if number == 0:
-		print("\nNo new recording found in directory \"{}\". Make sure to press the red button on the VLC window to start/end the recording.".format(inp))
-	while number > 0:
-		avi = files[number-1]
-		number-=1
-		while os.path.exists(output):
-			new = name + f"#{j}.avi"
-			output = os.path.join(out, new)
+	if args["segment"] > 0:
+		from Converter import ColorMapping # only needed to process segments
+		from Watch import processFile
+		colorMapping = ColorMapping.load(os.path.abspath(mapping)) if mapping else None
+		framesPath = os.path.abspath(frames_out or os.path.join(out, "frames"))
+		base = os.path.join(out, name)
+		j=2
+		while len(completedSegments(base, False)) > 0: #a new name for every session
+			base = os.path.join(out, name + f"#{j}")
 			j+=1
-		os.rename(avi, output)
-		print("\nSaved recording {} in directory \"{}\"".format(new, out))
+		values = {"fps": fps, "top": top, "left": left, "width": width, "height": height, "segment": segment,
+			"limit": "-t " + duration if args["duration"] > 0 else "", "output": base + "_%03d" + SEGMENT_EXTENSION}
+		process = lambda fileName: processFile(fileName, framesPath, colorMapping, args["transparent"], "", 0, 0, "default")
+		segmentCount, frameCount, errorCount = recordSegments(captureCommand(capture, values), base, process, args["workers"])
+		print("\nRecorded {} segment(s) into directory \"{}\" and processed {} image file(s) into \"{}\" with {} error(s)".format(segmentCount, out, frameCount, framesPath, errorCount))
+	else:
+		record(VLC, top, left, width, height, fps, inp, out, name)
     
 	if default == True:
 		VLC = repr(VLC) #Convert quotes into double quotes so the address is written later with quotes + deal with escape characters
 		inp = repr(args["inp"])
 		out = repr(args["out"])
 		name = repr(name)
-		data=[VLC, inp, top, left, width, height, fps, out, name]
+		capture = repr(capture)
+		mapping = repr(mapping)
+		frames_out = repr(frames_out)
+		data=[VLC, inp, top, left, width, height, fps, segment, capture, duration, out, name, mapping, frames_out, workers]
 		j=0
 		with open("Record.py","r") as e:
 			new = e.read().splitlines(True) #Grab each line and keep the \n endline character
@@ -142,6 +271,34 @@ def main():
 			e.write(''.join(new))
 			e.close()
 
+def record(VLC, top, left, width, height, fps, inp, out, name):
+	# single file with VLC: waits for VLC to close, then moves the new recording(s) from VLC's folder
+	path = os.path.join(inp, "*.avi")
+	before = len(glob.glob(path))
+
+	command = VLC+" screen:// :screen-fps="+fps+" :live-caching=300 :screen-top="+top+" :screen-left="+left+" :screen-width="+width+" :screen-height="+height
+	subprocess.call(command)
+
+	new = name + ".avi"
+	output = os.path.join(out, new)
+	j=2
+    
+	path = os.path.join(inp, "*.avi")
+	files = sorted(glob.glob(path), key=os.path.getmtime, reverse=True) #Sorts avi files by latest modification
+	after = len(files)
+	number = after - before
+	if number == 0:
+		print("\nNo new recording found in directory \"{}\". Make sure to press the red button on the VLC window to start/end the recording.".format(inp))
+	while number > 0:
+		avi = files[number-1]
+		number-=1
+		while os.path.exists(output):
+			new = name + f"#{j}.avi"
+			output = os.path.join(out, new)
+			j+=1
+		os.rename(avi, output)
+		print("\nSaved recording {} in directory \"{}\"".format(new, out))
+
 if __name__ == "__main__":
     result = main()
     sys.exit(result)
@@ -1,83 +1,134 @@
 import numpy as np
-from PIL import Image, ImageColor
-from moviepy.editor import VideoFileClip
+from PIL import Image
 import os.path
 #import argparse
 import time
 import sys
-import glob
-from gooey import Gooey, GooeyParser
-
-def frames(file, start, out, fps): # if fps = 10 and video is 20 sec, you save 200 frames
-	video = VideoFileClip(file)
-	if len(out) == 0:
-		out = file
-	name, _ = os.path.splitext(out)
-	start1 = time.perf_counter()
-	
-	if not os.path.isdir(name):
-		os.mkdir(name)
-	if fps == 0 or fps > video.fps: #can't save more frames than there are
-		fps = video.fps
-	step = 1/fps 
-	
-	f = len(glob.glob(f"{name}/*.png"))
-	g = f
-	for now in np.arange(start, video.duration, step):
-		g+=1
-		frame = os.path.join(name, f"frame#{g}.png")
-		video.save_frame(frame, now)
-		
-	error = video.duration // step + 1 - g
-	end1 = time.perf_counter()
-	elapsed = end1 - start1
-	print("\nSuccessfully extracted {} image file(s) from {} with {} error(s) in {:.3f}s\n\n".format(g-f, file, error, elapsed))
-	return name
-	
-def rgbaToInt32(r, g, b, a=255):
-    r = (r & 0xFF) << 0
-    g = (g & 0xFF) << 8
-    b = (b & 0xFF) << 16
-    a = (a & 0xFF) << 24
-    result = (r | g | b | a)
-    return result
-
-def loadMappingFromFile(mappingFileName):
-    start = time.perf_counter()
-    # fill in color mapping with all values set to full alpha (opaque)
-    mapping = np.arange(0xFF000000, 0xFFFFFFFF+1, 1, dtype=np.uint32)
-    with open(mappingFileName, "r") as mappingFile:
-        lines = mappingFile.read().splitlines()
-    lines = filter(lambda line: len(line) == 2, [line.split("#")[0].split(":")[:2] for line in lines])
-    pairs = [tuple(map(lambda x: ImageColor.getrgb(x.strip()), line)) for line in lines]
-    indices = np.array([rgbaToInt32(*oldColor[:3], 0) for oldColor, _ in pairs], dtype=np.uint32)
-    newColors = np.array([rgbaToInt32(*newColor) for _, newColor in pairs], dtype=np.uint32)
-    mapping[indices] = newColors
-    end = time.perf_counter()
-    elapsed = end - start
-    print("Loaded inverse color mapping with {} entries in {:.3f}s".format(len(indices), elapsed))
-    return mapping
+from functools import partial
+from Headless import Gooey, GooeyParser
+from Video import VIDEO_EXTENSIONS, frames, extractFrames, streamFrames
+from Batch import processBatch
+from Dedup import frameHash, reuseOutput, rememberOutput
+from Manifest import Manifest
+from Encode import PNG_PROFILES, PNG_STRATEGIES, pngOptions, EncoderPool
+from Pipeline import iterImageFiles, runPipeline
+from Mapping import hashMappingFile, loadMappingFromFile
+import Instrument
 
 def loadImage(imageFileName):
-    image = Image.open(imageFileName).convert("RGBA")
+    with Instrument.stage("png decode"):
+        image = Image.open(imageFileName).convert("RGBA")
     return image
 
+def frameBuffers(buffers, count, height, width, names=("indices", "result")):
+    # named uint32 stacks ("input", "indices", "result"), grown when needed and reused across batches
+    stacks = []
+    for name in names:
+        key = (name, height, width)
+        if key not in buffers or len(buffers[key]) < count:
+            buffers[key] = np.empty((count, height, width), dtype=np.uint32)
+        stacks.append(buffers[key][:count])
+    return tuple(stacks)
+
+def transformFrames(frames, mapping, buffers=None):
+    # frames is an (N, H, W, 4) uint8 stack; the result is a view into the reusable result buffer
+    if buffers is None:
+        buffers = {}
+    frames = np.ascontiguousarray(frames, dtype=np.uint8)
+    count, height, width = frames.shape[:3]
+    indices, result = frameBuffers(buffers, count, height, width)
+    with Instrument.stage("lut transform", count):
+        np.bitwise_and(frames.view(dtype=np.uint32)[..., 0], 0x00FFFFFF, out=indices) # drop alpha (the mapping will restore it)
+        np.take(mapping, indices, out=result, mode="clip") # indices are always < 2^24, "clip" avoids an extra output copy
+    return result.view(dtype=np.uint8).reshape(frames.shape)
+
 def transformImageColors(image, mapping):
-    data = np.array(image)
-    data[:, :, 3] = 0 # set alpha to 0 across the whole image (the mapping will restore it)
-    rawData = data.view(dtype=np.uint32)
-    rawData = mapping[rawData]
-    result = Image.fromarray(rawData, mode="RGBA")
+    data = np.asarray(image)
+    rawData = transformFrames(data[np.newaxis], mapping)
+    result = Image.fromarray(rawData[0]) # (H, W, 4) uint8 is RGBA
     return result
 
-def processImageFile(inputFileName, outputFileName, mapping):
+def processImage(sourceImage, inputFileName, outputFileName, mapping, seen=None, encoder=None, done=None):
     start = time.perf_counter()
-    sourceImage = loadImage(inputFileName)
+    if encoder is None:
+        encoder = EncoderPool() # write right away with Pillow's default PNG settings
+    def finished():
+        end = time.perf_counter()
+        elapsed = end - start
+        print("Wrote output image file \"{}\" (took {:.3f}s)".format(outputFileName, elapsed))
+        if done is not None:
+            done(inputFileName, outputFileName)
+    key = frameHash(np.asarray(sourceImage)) if seen is not None else None
+    if reuseOutput(seen, key, outputFileName, lambda source, target: encoder.copy(source, target, finished)):
+        print("Reusing output image file \"{}\" for identical frame \"{}\"".format(seen[key], outputFileName))
+        return
     transformedImage = transformImageColors(sourceImage, mapping)
-    transformedImage.save(outputFileName)
-    end = time.perf_counter()
-    elapsed = end - start
-    print("Wrote output image file \"{}\" (took {:.3f}s)".format(outputFileName, elapsed))
+    encoder.save(transformedImage, outputFileName, finished)
+    rememberOutput(seen, key, outputFileName)
+
+def processImageFile(inputFileName, outputFileName, mapping, seen=None, encoder=None, done=None):
+    processImage(loadImage(inputFileName), inputFileName, outputFileName, mapping, seen, encoder, done)
+
+def processImageBatch(jobs, mapping, buffers, seen=None, done=None, encoder=None):
+    # load a batch of images into the reusable input stack, transform them all at once, then save each one
+    if encoder is None:
+        encoder = EncoderPool()
+    def finisher(inputFileName, outputFileName):
+        if done is None:
+            return None
+        return lambda: done(inputFileName, outputFileName)
+    imagesProcessedCount, errorCount = 0, 0
+    loaded = {}
+    duplicates = {} # frame hash -> output files waiting on a frame earlier in this batch
+    for inputFileName, outputFileName in jobs:
+        print("")
+        try:
+            print("Processing image file \"{}\"...".format(inputFileName))
+            data = np.asarray(loadImage(inputFileName))
+            key = frameHash(data) if seen is not None else None
+            if reuseOutput(seen, key, outputFileName, lambda source, target: encoder.copy(source, target, finisher(inputFileName, outputFileName))):
+                imagesProcessedCount += 1
+                continue
+            if key in duplicates:
+                duplicates[key].append((inputFileName, outputFileName))
+                continue
+            if key is not None:
+                duplicates[key] = []
+            loaded.setdefault(data.shape, []).append((data, key, inputFileName, outputFileName))
+        except Exception as e:
+            print("Error while processing image file \"{}\":".format(inputFileName))
+            print(e)
+            errorCount += 1
+    for shape, images in loaded.items(): # frames of different sizes go through separate stacks
+        start = time.perf_counter()
+        inputs, = frameBuffers(buffers, len(images), shape[0], shape[1], ("input",))
+        stack = inputs.view(dtype=np.uint8).reshape((len(images),) + shape)
+        for i, (data, _, _, _) in enumerate(images):
+            stack[i] = data
+        results = transformFrames(stack, mapping, buffers)
+        for i, (_, key, inputFileName, outputFileName) in enumerate(images):
+            try:
+                # copy out of the result buffer, which the next batch reuses (possibly before the write is done)
+                encoder.save(Image.fromarray(results[i].copy()), outputFileName, finisher(inputFileName, outputFileName))
+                rememberOutput(seen, key, outputFileName)
+                imagesProcessedCount += 1
+            except Exception as e:
+                print("Error while processing image file \"{}\":".format(inputFileName))
+                print(e)
+                errorCount += 1
+                continue
+            for duplicateInputFileName, duplicateOutputFileName in duplicates.get(key, []):
+                try:
+                    reuseOutput(seen, key, duplicateOutputFileName, lambda source, target: encoder.copy(source, target, finisher(duplicateInputFileName, duplicateOutputFileName)))
+                    imagesProcessedCount += 1
+                except Exception as e:
+                    print("Error while processing image file \"{}\":".format(duplicateInputFileName))
+                    print(e)
+                    errorCount += 1
+        end = time.perf_counter()
+        elapsed = end - start
+        print("Wrote {} output image file(s) of size {}x{} (took {:.3f}s)".format(len(images), shape[1], shape[0], elapsed))
+    return imagesProcessedCount, errorCount
 
 @Gooey(program_description="Changes black into transparency then reverts the generated palettes to the originals.", default_size=(690, 600), optional_cols=1, tabbed_groups=True)
 def main():
@@ -105,6 +156,14 @@ def main():
 	input_group.add_argument("-v", "--video",
 		action="store_true",
 		help="The file(s) provided are video(s) from which to extract the images.")
+	input_group.add_argument("-nc", "--no_compiled",
+		action="store_true",
+		help="Always parse the text mapping file instead of using (or creating) its compiled copy.")
+	input_group.add_argument("-md", "--max_distance",
+		type=int,
+		default=-1,
+		help="How far (per R/G/B channel) a captured color may be from a color of a compact mapping file. Put -1 to use the distance written in the mapping file.",
+		widget="IntegerField")
 	
 	video_group = parser.add_argument_group(
 		"Video Options",
@@ -124,6 +183,9 @@ def main():
 		default="",
 		help="Single name/path to store the frames extracted from the video(s).",
 		widget="DirChooser")
+	video_group.add_argument("-st", "--stream",
+		action="store_true",
+		help="Decode the video(s) straight into memory and only write the final images (no intermediate frame files).")
 		
 	output_group = parser.add_argument_group(
 		"Output",
@@ -139,9 +201,66 @@ def main():
 	output_group.add_argument("-e", "--extract_only",
 		action="store_true",
 		help="Only extract frames from video(s) and do nothing to them.")
+	output_group.add_argument("-fr", "--fresh",
+		action="store_true",
+		help="Ignore the job manifests and redo every frame and image file instead of resuming.")
 	output_group.add_argument("-d", "--default",
 		action="store_true",
 		help="Set the current values as the new default configuration.")
+
+	performance_group = parser.add_argument_group(
+		"Performance",
+		"Spread the work over several processes, or batch it in one.")
+	performance_group.add_argument("-j", "--workers",
+		type=int,
+		default=1,
+		help="Number of worker processes for image files and video frame extraction. Put 0 to use every CPU core.",
+		widget="IntegerField")
+	performance_group.add_argument("-u", "--dedup",
+		action="store_true",
+		help="Reuse the output of an earlier identical frame instead of processing it again (single worker only).")
+	performance_group.add_argument("-pp", "--png_profile",
+		default="default",
+		choices=list(PNG_PROFILES),
+		help="PNG compression profile for output images. 'fast' suits intermediate frames, 'small' final ones.",
+		widget="Dropdown")
+	performance_group.add_argument("-pl", "--png_level",
+		type=int,
+		default=-1,
+		help="zlib compression level (0-9) overriding the profile's. Put -1 to keep the profile's.",
+		widget="IntegerField",
+		gooey_options={'min':-1, 'max':9})
+	performance_group.add_argument("-ps", "--png_strategy",
+		default="profile",
+		choices=list(PNG_STRATEGIES),
+		help="zlib strategy overriding the profile's.",
+		widget="Dropdown")
+	performance_group.add_argument("-et", "--encode_threads",
+		type=int,
+		default=0,
+		help="Number of threads encoding and writing output images while the next ones are processed. Put 0 to write each image before moving on.",
+		widget="IntegerField")
+	performance_group.add_argument("-rt", "--read_threads",
+		type=int,
+		default=0,
+		help="Number of threads decoding input images ahead of the transform when using a single worker. Put 0 to read each image when needed.",
+		widget="IntegerField")
+	performance_group.add_argument("-q", "--queue",
+		type=int,
+		default=8,
+		help="Maximum number of decoded input images waiting for the transform (with read threads).",
+		widget="IntegerField")
+	performance_group.add_argument("-b", "--batch",
+		type=int,
+		default=1,
+		help="Number of image files to load and transform together when using a single worker.",
+		widget="IntegerField")
+	performance_group.add_argument("-pr", "--perf_report",
+		action="store_true",
+		help="Write a JSON performance report (time per stage, frames per second, peak memory) to the output folder at the end of the run.")
+	performance_group.add_argument("-pf", "--profile",
+		action="store_true",
+		help="Also profile the run with cProfile, saved next to the performance report.")
     
 	"""
 	if len(sys.argv) < 2:
@@ -158,6 +277,17 @@ def main():
 	imageFileNames = args["inputFiles"]
 	outputPath = os.path.abspath(args["outputPath"])
 	extract_only = args["extract_only"]
+	fresh = args["fresh"]
+	stream = args["stream"] and not extract_only
+	workers = args["workers"]
+	seen = {} if args["dedup"] else None # frame hash -> output file
+	batch = args["batch"]
+	png_profile = args["png_profile"]
+	png_level = args["png_level"]
+	png_strategy = args["png_strategy"]
+	encode_threads = args["encode_threads"]
+	read_threads = args["read_threads"]
+	queue = args["queue"]
 	default = args["default"]
 	
 	if not folders or not os.path.exists(os.path.abspath(folders[0])):
@@ -166,24 +296,42 @@ def main():
 			parser.print_help()
 			sys.exit()
 
+	if args["perf_report"] or args["profile"]:
+		Instrument.start("ReverseColors", args, os.path.join(outputPath, "ReverseColors.report.json"), os.path.join(outputPath, "ReverseColors.prof") if args["profile"] else None)
 	start1 = time.perf_counter()
 	if not os.path.exists(outputPath):
 		os.makedirs(outputPath)
 		print("Created output directory \"{}\"".format(outputPath))
+	manifestFileName = os.path.join(outputPath, "ReverseColors.manifest.json")
 	inversePaletteMappingPath = os.path.abspath(args["mapping"])
-	mapping = loadMappingFromFile(inversePaletteMappingPath)
+	max_distance = args["max_distance"]
+	mapping = loadMappingFromFile(inversePaletteMappingPath, not args["no_compiled"], max_distance if max_distance >= 0 else None)
 	imagesProcessedCount, errorCount = 0, 0
+	encoder = EncoderPool(encode_threads, pngOptions(png_profile, png_level, png_strategy))
 	
 	#if not any(".png" in name.lower() for name in imageFileNames): folder = True
-	if imageFileNames and any(vid in name.lower() for vid in [".mp4",".avi",".mkv",".webm"] for name in imageFileNames): video = True
+	if imageFileNames and any(vid in name.lower() for vid in VIDEO_EXTENSIONS for name in imageFileNames): video = True
 	
-	if video:
+	if video and not stream and workers != 1: # decode each video in parallel time ranges
+		for folder in extractFrames(imageFileNames, start, video_out, fps, workers, fresh):
+			if not folder in folders:
+				folders.append(folder)
+		if extract_only:
+			sys.exit()
+	elif video:
 		for vid in imageFileNames: # Takes a vid from input
-			folder = frames(vid, start, video_out, fps)
+			if stream:
+				count, errors = streamFrames(vid, start, video_out, fps, outputPath, name, lambda frame: transformImageColors(frame, mapping), seen, encoder)
+				imagesProcessedCount += count
+				errorCount += errors
+				continue
+			folder = frames(vid, start, video_out, fps, fresh)
 			if not folder in folders:
 				folders.append(folder) # Makes a folder out of each vid and keeps the paths
 		if extract_only:
 			sys.exit()
+		if stream:
+			imageFileNames = [] # already fully processed
 
 	if len(folders)!=0:
 		imageFileNames = folders
@@ -191,7 +339,7 @@ def main():
 		output=[]
 		for f in imageFileNames:
 			folder = os.path.abspath(f)
-			files.append(glob.glob(os.path.join(folder, "*.png"))) #creates a list of all *.png filenames in folder and appends it to files
+			files.append(iterImageFiles(folder)) #lists the *.png filenames in folder (a snapshot) and appends it to files
 			out = os.path.abspath(os.path.join(outputPath, f))
 			if out == f: #when given path outside code folder
 				f = f.split("\\")[-1]
@@ -204,46 +352,65 @@ def main():
 		outputPath = output
 		inputImagePaths = [map(os.path.abspath, i) for i in files]
 		
-		j = 0
-		for inputFileList in inputImagePaths:
-			for inputFileName in inputFileList:
-				baseFileName = os.path.basename(inputFileName)
-				outputFileName = os.path.abspath(os.path.join(outputPath[j], name+baseFileName)) #adds naming scheme to outputfiles
+		jobs = ((inputFileName, os.path.abspath(os.path.join(outputPath[j], name+os.path.basename(inputFileName)))) #adds naming scheme to outputfiles
+			for j, inputFileList in enumerate(inputImagePaths) for inputFileName in inputFileList)
+	else:
+		inputImagePaths = map(os.path.abspath, imageFileNames)
+		jobs = ((inputFileName, os.path.abspath(os.path.join(outputPath, name+os.path.basename(inputFileName))))
+			for inputFileName in inputImagePaths)
+
+	# skip the image files already done under the same settings by an earlier (possibly interrupted) run
+	manifest = Manifest(manifestFileName, {"mapping": hashMappingFile(inversePaletteMappingPath), "distance": max_distance, "name": name}, fresh)
+	jobs = manifest.pendingFiles(jobs) # checked one job at a time, as they are processed
+
+	try:
+		if workers == 1 and read_threads > 0:
+			process = lambda sourceImage, inputFileName, outputFileName: processImage(sourceImage, inputFileName, outputFileName, mapping, seen, encoder, manifest.completeFile)
+			count, errors = runPipeline(jobs, loadImage, process, read_threads, queue)
+			imagesProcessedCount += count
+			errorCount += errors
+		elif workers == 1 and batch > 1:
+			jobs = list(jobs)
+			buffers = {}
+			for i in range(0, len(jobs), batch):
+				count, errors = processImageBatch(jobs[i:i+batch], mapping, buffers, seen, manifest.completeFile, encoder)
+				imagesProcessedCount += count
+				errorCount += errors
+		elif workers == 1:
+			for inputFileName, outputFileName in jobs:
 				print("")
 				try:
 					print("Processing image file \"{}\"...".format(inputFileName))
-					processImageFile(inputFileName, outputFileName, mapping)
+					processImageFile(inputFileName, outputFileName, mapping, seen, encoder, manifest.completeFile)
 					imagesProcessedCount += 1
 				except Exception as e:
 					print("Error while processing image file \"{}\":".format(inputFileName))
 					print(e)
 					errorCount += 1
-			j+=1
-	else:
-		inputImagePaths = map(os.path.abspath, imageFileNames)
-		for inputFileName in inputImagePaths:
-			baseFileName = os.path.basename(inputFileName)
-			outputFileName = os.path.abspath(os.path.join(outputPath, name+baseFileName))
-			print("")
-			try:
-				print("Processing image file \"{}\"...".format(inputFileName))
-				processImageFile(inputFileName, outputFileName, mapping)
-				imagesProcessedCount += 1
-			except Exception as e:
-				print("Error while processing image file \"{}\":".format(inputFileName))
-				print(e)
-				errorCount += 1
+		else:
+			count, errors = processBatch(list(jobs), partial(processImageFile, encoder=encoder), workers, mapping, done=manifest.completeFile)
+			imagesProcessedCount += count
+			errorCount += errors
+	finally:
+		encodeErrors = encoder.close() # wait for the last writes
+		imagesProcessedCount -= encodeErrors
+		errorCount += encodeErrors
+		manifest.save()
+	if manifest.skipped > 0:
+		print("\nSkipped {} image file(s) already up to date".format(manifest.skipped))
 
 	end1 = time.perf_counter()
 	elapsed = end1 - start1
 	print("\nProcessed {} image file(s) with {} error(s) in {:.3f}s".format(imagesProcessedCount, errorCount, elapsed))
+	Instrument.countFrames(imagesProcessedCount)
+	Instrument.finish()
 
 	if default == True:
 		mapping = repr(args["mapping"]) #Convert quotes into double quotes so the address is written later with quotes + deal with escape characters
 		video_out = repr(video_out)
 		name = repr(name)
 		output = repr(args["outputPath"])
-		data=[mapping, start, fps, video_out, name, output]
+		data=[mapping, max_distance, start, fps, video_out, name, output, workers, repr(png_profile), png_level, repr(png_strategy), encode_threads, read_threads, queue, batch]
 		j=0
 		with open("ReverseColors.py","r") as e:
 			new = e.read().splitlines(True) #Grab each line and keep the \n endline character
@@ -1,53 +1,59 @@
 import numpy as np
 from PIL import Image, ImageColor
-from moviepy.editor import VideoFileClip
 import os.path
 #import argparse
 import time
 import sys
-import glob
-from gooey import Gooey, GooeyParser
+from functools import partial
+from Headless import Gooey, GooeyParser
+from Video import VIDEO_EXTENSIONS, frames, extractFrames, streamFrames
+from Batch import processBatch
+from Dedup import frameHash, reuseOutput, rememberOutput
+from Manifest import Manifest
+from Encode import PNG_PROFILES, PNG_STRATEGIES, pngOptions, EncoderPool
+from Pipeline import iterImageFiles, runPipeline
+import Instrument
 	
-def frames(file, start, out, fps): # if fps = 10 and video is 20 sec, you save 200 frames
-	video = VideoFileClip(file)
-	if len(out) == 0:
-		out = file
-	name, _ = os.path.splitext(out)
-	start1 = time.perf_counter()
-	
-	if not os.path.isdir(name):
-		os.mkdir(name)
-	if fps == 0 or fps > video.fps: #can't save more frames than there are
-		fps = video.fps
-	step = 1/fps 
-	
-	f = len(glob.glob(f"{name}/*.png"))
-	g = f
-	for now in np.arange(start, video.duration, step):
-		g+=1
-		frame = os.path.join(name, f"frame#{g}.png")
-		video.save_frame(frame, now)
-		
-	error = video.duration // step + 1 - (g - f)
-	end1 = time.perf_counter()
-	elapsed = end1 - start1
-	print("\nSuccessfully extracted {} image file(s) from {} with {} error(s) in {:.3f}s\n\n".format(g-f, file, error, elapsed))
-	return name
-
-def remove_black(imageFileName):
-  image = np.array(Image.open(imageFileName).convert("RGBA"))
+def remove_black_array(image):
+  # in place on an (..., 4) RGBA array
   x = (image[...,:3] == np.array((0,0,0))).all(axis=-1)
   image[x,3] = 0
+  return image
+
+@Instrument.timed("remove_black")
+def remove_black_frame(image):
+  image = remove_black_array(np.array(image))
   result = Image.fromarray(image)
   return result
 
-def processImageFile(inputFileName, outputFileName):
+def loadImage(imageFileName):
+    with Instrument.stage("png decode"):
+        image = Image.open(imageFileName).convert("RGBA")
+    return image
+
+def remove_black(imageFileName):
+  return remove_black_frame(loadImage(imageFileName))
+
+def processImage(sourceImage, inputFileName, outputFileName, seen=None, encoder=None, done=None):
     start = time.perf_counter()
-    transformedImage = remove_black(inputFileName)
-    transformedImage.save(outputFileName)
-    end = time.perf_counter()
-    elapsed = end - start
-    print("Wrote output image file \"{}\" (took {:.3f}s)".format(outputFileName, elapsed))
+    if encoder is None:
+        encoder = EncoderPool() # write right away with Pillow's default PNG settings
+    def finished():
+        end = time.perf_counter()
+        elapsed = end - start
+        print("Wrote output image file \"{}\" (took {:.3f}s)".format(outputFileName, elapsed))
+        if done is not None:
+            done(inputFileName, outputFileName)
+    key = frameHash(np.asarray(sourceImage)) if seen is not None else None
+    if reuseOutput(seen, key, outputFileName, lambda source, target: encoder.copy(source, target, finished)):
+        print("Reusing output image file \"{}\" for identical frame \"{}\"".format(seen[key], outputFileName))
+        return
+    transformedImage = remove_black_frame(sourceImage)
+    encoder.save(transformedImage, outputFileName, finished)
+    rememberOutput(seen, key, outputFileName)
+
+def processImageFile(inputFileName, outputFileName, seen=None, encoder=None, done=None):
+    processImage(loadImage(inputFileName), inputFileName, outputFileName, seen, encoder, done)
 	
 @Gooey(program_description="Changes true black into full transparency on every image provided.", default_size=(690, 600), optional_cols=1, tabbed_groups=True)
 def main():
@@ -88,6 +94,9 @@ def main():
 		default="",
 		help="Single name/path to store the frames extracted from the video(s).",
 		widget="DirChooser")
+	video_group.add_argument("-st", "--stream",
+		action="store_true",
+		help="Decode the video(s) straight into memory and only write the final images (no intermediate frame files).")
 		
 	output_group = parser.add_argument_group(
 		"Output",
@@ -103,9 +112,61 @@ def main():
 	output_group.add_argument("-e", "--extract_only",
 		action="store_true",
 		help="Only extract frames from video(s) and do nothing to them.")
+	output_group.add_argument("-fr", "--fresh",
+		action="store_true",
+		help="Ignore the job manifests and redo every frame and image file instead of resuming.")
 	output_group.add_argument("-d", "--default",
 		action="store_true",
 		help="Set the current values as the new default configuration.")
+
+	performance_group = parser.add_argument_group(
+		"Performance",
+		"Spread the work over several processes.")
+	performance_group.add_argument("-j", "--workers",
+		type=int,
+		default=1,
+		help="Number of worker processes for image files and video frame extraction. Put 0 to use every CPU core.",
+		widget="IntegerField")
+	performance_group.add_argument("-u", "--dedup",
+		action="store_true",
+		help="Reuse the output of an earlier identical frame instead of processing it again (single worker only).")
+	performance_group.add_argument("-pp", "--png_profile",
+		default="default",
+		choices=list(PNG_PROFILES),
+		help="PNG compression profile for output images. 'fast' suits intermediate frames, 'small' final ones.",
+		widget="Dropdown")
+	performance_group.add_argument("-pl", "--png_level",
+		type=int,
+		default=-1,
+		help="zlib compression level (0-9) overriding the profile's. Put -1 to keep the profile's.",
+		widget="IntegerField",
+		gooey_options={'min':-1, 'max':9})
+	performance_group.add_argument("-ps", "--png_strategy",
+		default="profile",
+		choices=list(PNG_STRATEGIES),
+		help="zlib strategy overriding the profile's.",
+		widget="Dropdown")
+	performance_group.add_argument("-et", "--encode_threads",
+		type=int,
+		default=0,
+		help="Number of threads encoding and writing output images while the next ones are processed. Put 0 to write each image before moving on.",
+		widget="IntegerField")
+	performance_group.add_argument("-rt", "--read_threads",
+		type=int,
+		default=0,
+		help="Number of threads decoding input images ahead of the transform when using a single worker. Put 0 to read each image when needed.",
+		widget="IntegerField")
+	performance_group.add_argument("-q", "--queue",
+		type=int,
+		default=8,
+		help="Maximum number of decoded input images waiting for the transform (with read threads).",
+		widget="IntegerField")
+	performance_group.add_argument("-pr", "--perf_report",
+		action="store_true",
+		help="Write a JSON performance report (time per stage, frames per second, peak memory) to the output folder at the end of the run.")
+	performance_group.add_argument("-pf", "--profile",
+		action="store_true",
+		help="Also profile the run with cProfile, saved next to the performance report.")
 	
 	"""
 	if len(sys.argv) < 2:
@@ -122,6 +183,16 @@ def main():
 	imageFileNames = args["inputFiles"]
 	outputPath = os.path.abspath(args["outputPath"])
 	extract_only = args["extract_only"]
+	fresh = args["fresh"]
+	stream = args["stream"] and not extract_only
+	workers = args["workers"]
+	seen = {} if args["dedup"] else None # frame hash -> output file
+	png_profile = args["png_profile"]
+	png_level = args["png_level"]
+	png_strategy = args["png_strategy"]
+	encode_threads = args["encode_threads"]
+	read_threads = args["read_threads"]
+	queue = args["queue"]
 	default = args["default"]
 	
 	if not folders or not os.path.exists(os.path.abspath(folders[0])):
@@ -130,22 +201,39 @@ def main():
 			parser.print_help()
 			sys.exit()
 
+	if args["perf_report"] or args["profile"]:
+		Instrument.start("Transparent", args, os.path.join(outputPath, "Transparent.report.json"), os.path.join(outputPath, "Transparent.prof") if args["profile"] else None)
 	start1 = time.perf_counter()
 	if not os.path.exists(outputPath):
 		os.makedirs(outputPath)
 		print("Created output directory \"{}\"".format(outputPath))
+	manifestFileName = os.path.join(outputPath, "Transparent.manifest.json")
 	imagesProcessedCount, errorCount = 0, 0
+	encoder = EncoderPool(encode_threads, pngOptions(png_profile, png_level, png_strategy))
 	
 	#if not any(".png" in name.lower() for name in imageFileNames): folder = True
-	if imageFileNames and any(vid in name.lower() for vid in [".mp4",".avi",".mkv",".webm"] for name in imageFileNames): video = True
+	if imageFileNames and any(vid in name.lower() for vid in VIDEO_EXTENSIONS for name in imageFileNames): video = True
 	
-	if video:
+	if video and not stream and workers != 1: # decode each video in parallel time ranges
+		for folder in extractFrames(imageFileNames, start, video_out, fps, workers, fresh):
+			if not folder in folders:
+				folders.append(folder)
+		if extract_only:
+			sys.exit()
+	elif video:
 		for vid in imageFileNames: # Takes a vid from input
-			folder = frames(vid, start, video_out, fps)
+			if stream:
+				count, errors = streamFrames(vid, start, video_out, fps, outputPath, name, lambda frame: remove_black_frame(frame), seen, encoder)
+				imagesProcessedCount += count
+				errorCount += errors
+				continue
+			folder = frames(vid, start, video_out, fps, fresh)
 			if not folder in folders:
 				folders.append(folder) # Makes a folder out of each vid and keeps the paths
 		if extract_only:
 			sys.exit()
+		if stream:
+			imageFileNames = [] # already fully processed
 
 	if len(folders)!=0:
 		imageFileNames = folders
@@ -153,7 +241,7 @@ def main():
 		output=[]
 		for f in imageFileNames:
 			folder = os.path.abspath(f)
-			files.append(glob.glob(os.path.join(folder, "*.png"))) #creates a list of all *.png filenames in folder and appends it to files
+			files.append(iterImageFiles(folder)) #lists the *.png filenames in folder (a snapshot) and appends it to files
 			out = os.path.abspath(os.path.join(outputPath, f))
 			if out == f: #when given path outside code folder
 				f = f.split("\\")[-1]
@@ -166,45 +254,57 @@ def main():
 		outputPath = output
 		inputImagePaths = [map(os.path.abspath, i) for i in files]
 		
-		j = 0
-		for inputFileList in inputImagePaths:
-			for inputFileName in inputFileList:
-				baseFileName = os.path.basename(inputFileName)
-				outputFileName = os.path.abspath(os.path.join(outputPath[j], name+baseFileName)) #adds naming scheme to outputfiles
+		jobs = ((inputFileName, os.path.abspath(os.path.join(outputPath[j], name+os.path.basename(inputFileName)))) #adds naming scheme to outputfiles
+			for j, inputFileList in enumerate(inputImagePaths) for inputFileName in inputFileList)
+	else:
+		inputImagePaths = map(os.path.abspath, imageFileNames)
+		jobs = ((inputFileName, os.path.abspath(os.path.join(outputPath, name+os.path.basename(inputFileName))))
+			for inputFileName in inputImagePaths)
+
+	# skip the image files already done under the same settings by an earlier (possibly interrupted) run
+	manifest = Manifest(manifestFileName, {"name": name}, fresh)
+	jobs = manifest.pendingFiles(jobs) # checked one job at a time, as they are processed
+
+	try:
+		if workers == 1 and read_threads > 0:
+			process = lambda sourceImage, inputFileName, outputFileName: processImage(sourceImage, inputFileName, outputFileName, seen, encoder, manifest.completeFile)
+			count, errors = runPipeline(jobs, loadImage, process, read_threads, queue)
+			imagesProcessedCount += count
+			errorCount += errors
+		elif workers == 1:
+			for inputFileName, outputFileName in jobs:
 				print("")
 				try:
 					print("Processing image file \"{}\"...".format(inputFileName))
-					processImageFile(inputFileName, outputFileName)
+					processImageFile(inputFileName, outputFileName, seen, encoder, manifest.completeFile)
 					imagesProcessedCount += 1
 				except Exception as e:
 					print("Error while processing image file \"{}\":".format(inputFileName))
 					print(e)
 					errorCount += 1
-			j+=1
-	else:
-		inputImagePaths = map(os.path.abspath, imageFileNames)
-		for inputFileName in inputImagePaths:
-			baseFileName = os.path.basename(inputFileName)
-			outputFileName = os.path.abspath(os.path.join(outputPath, name+baseFileName))
-			print("")
-			try:
-				print("Processing image file \"{}\"...".format(inputFileName))
-				processImageFile(inputFileName, outputFileName)
-				imagesProcessedCount += 1
-			except Exception as e:
-				print("Error while processing image file \"{}\":".format(inputFileName))
-				print(e)
-				errorCount += 1
+		else:
+			count, errors = processBatch(list(jobs), partial(processImageFile, encoder=encoder), workers, done=manifest.completeFile)
+			imagesProcessedCount += count
+			errorCount += errors
+	finally:
+		encodeErrors = encoder.close() # wait for the last writes
+		imagesProcessedCount -= encodeErrors
+		errorCount += encodeErrors
+		manifest.save()
+	if manifest.skipped > 0:
+		print("\nSkipped {} image file(s) already up to date".format(manifest.skipped))
 
 	end1 = time.perf_counter()
 	elapsed = end1 - start1
 	print("\nProcessed {} image file(s) with {} error(s) in {:.3f}s".format(imagesProcessedCount, errorCount, elapsed))
+	Instrument.countFrames(imagesProcessedCount)
+	Instrument.finish()
 
 	if default == True:
 		video_out = repr(video_out) #Convert quotes into double quotes so the address is written later with quotes + deal with escape characters
 		name = repr(name)
 		output = repr(args["outputPath"])
-		data=[start, fps, video_out, name, output]
+		data=[start, fps, video_out, name, output, workers, repr(png_profile), png_level, repr(png_strategy), encode_threads, read_threads, queue]
 		j=0
 		with open("Transparent.py","r") as e:
 			new = e.read().splitlines(True) #Grab each line and keep the \n endline character
@@ -0,0 +1,214 @@
+import numpy as np
+from PIL import Image
+import os.path
+import time
+import glob
+import math
+from multiprocessing import Pool
+from Dedup import frameHash, reuseOutput, rememberOutput
+from Manifest import Manifest, fileStamp
+from Encode import EncoderPool, writeImage
+import Instrument
+
+VIDEO_EXTENSIONS = [".mp4",".avi",".mkv",".webm"]
+
+def openVideo(file):
+	from moviepy.editor import VideoFileClip # slow to import, only loaded once a video is actually opened
+	return VideoFileClip(file)
+
+def frameTimes(video, start, fps):
+	if fps == 0 or fps > video.fps: #can't save more frames than there are
+		fps = video.fps
+	step = 1/fps
+	return np.arange(start, video.duration, step), step
+
+def frameFolder(file, out):
+	if len(out) == 0:
+		out = file
+	name, _ = os.path.splitext(out)
+	return name
+
+def saveFrame(video, fileName, now):
+	# same as video.save_frame(), with decoding and writing timed apart
+	with Instrument.stage("video decode"):
+		frame = video.get_frame(now)
+	writeImage(Image.fromarray(frame), fileName)
+
+def frameManifest(file, name, start, fps, fresh=False, offset=0):
+	# one manifest per source video, so several videos can share a frame folder
+	manifestFileName = os.path.join(name, os.path.basename(file) + ".manifest.json")
+	settings = {"source": os.path.abspath(file), "stamp": fileStamp(file), "start": start, "fps": fps}
+	manifest = Manifest(manifestFileName, settings, fresh)
+	if "offset" not in manifest.info: # first run: number after the frames already in the folder
+		manifest.info["offset"] = max(offset, len(glob.glob(os.path.join(glob.escape(name), "*.png"))))
+	return manifest
+
+def frames(file, start, out, fps, fresh=False): # if fps = 10 and video is 20 sec, you save 200 frames
+	video = openVideo(file)
+	name = frameFolder(file, out)
+	start1 = time.perf_counter()
+
+	if not os.path.isdir(name):
+		os.mkdir(name)
+	times, step = frameTimes(video, start, fps)
+
+	manifest = frameManifest(file, name, start, fps, fresh)
+	f = manifest.info["offset"]
+	g = f
+	skipped = 0
+	try:
+		for now in times:
+			g+=1
+			frame = os.path.join(name, f"frame#{g}.png")
+			if manifest.isDone(str(g), float(now)) and os.path.exists(frame):
+				skipped += 1
+				continue
+			saveFrame(video, frame, now)
+			manifest.complete(str(g), float(now))
+	finally:
+		manifest.save()
+		video.close()
+
+	error = video.duration // step + 1 - (g - f)
+	end1 = time.perf_counter()
+	elapsed = end1 - start1
+	if skipped > 0:
+		print("\nSkipped {} image file(s) already extracted from {}".format(skipped, file))
+	print("\nSuccessfully extracted {} image file(s) from {} with {} error(s) in {:.3f}s\n\n".format(g-f-skipped, file, error, elapsed))
+	return name
+
+def extractChunk(task):
+	# runs in a worker process: decode one contiguous range of frames in order
+	file, name, chunk = task
+	video = openVideo(file)
+	completed, errors = [], []
+	try:
+		for g, now in chunk:
+			try:
+				saveFrame(video, os.path.join(name, f"frame#{g}.png"), now)
+				completed.append((g, now))
+			except Exception as e:
+				errors.append((g, str(e)))
+	finally:
+		video.close()
+	return file, completed, errors, Instrument.take()
+
+def extractFrames(files, start, out, fps, workers=0, fresh=False):
+	# parallel frames(): every video is split into contiguous time ranges, each decoded
+	# sequentially by its own worker, and videos run concurrently; frame#N names come from
+	# the frame's index in the video (plus the folder offset), so they don't depend on timing
+	if workers <= 0:
+		workers = os.cpu_count() or 1
+	start1 = time.perf_counter()
+	folders, manifests, expected, counts = [], {}, {}, {}
+	nextOffset = {} # frame folder -> first free frame# when several videos share it
+	tasks = []
+	for file in files:
+		name = frameFolder(file, out)
+		if not os.path.isdir(name):
+			os.makedirs(name)
+		if not name in folders:
+			folders.append(name)
+		video = openVideo(file)
+		try:
+			times, step = frameTimes(video, start, fps)
+			expected[file] = video.duration // step + 1
+		finally:
+			video.close()
+		manifest = frameManifest(file, name, start, fps, fresh, nextOffset.get(name, 0))
+		offset = manifest.info["offset"]
+		nextOffset[name] = max(nextOffset.get(name, 0), offset + len(times))
+		manifests[file] = manifest
+		pending = [(offset + i + 1, float(now)) for i, now in enumerate(times)
+			if not (manifest.isDone(str(offset + i + 1), float(now)) and os.path.exists(os.path.join(name, f"frame#{offset + i + 1}.png")))]
+		counts[file] = [len(times) - len(pending), 0] # skipped, extracted
+		size = max(1, math.ceil(len(pending) / workers))
+		tasks += [(file, name, pending[i:i+size]) for i in range(0, len(pending), size)]
+
+	try:
+		if len(tasks) > 0:
+			with Pool(min(workers, len(tasks)), initializer=Instrument.startWorker if Instrument.enabled() else None) as pool:
+				for file, completed, errors, stages in pool.imap_unordered(extractChunk, tasks):
+					Instrument.merge(stages)
+					for g, now in completed:
+						manifests[file].complete(str(g), now)
+					counts[file][1] += len(completed)
+					for g, e in errors:
+						print("Error while extracting frame#{} from {}:".format(g, file))
+						print(e)
+	finally:
+		for manifest in manifests.values():
+			manifest.save()
+
+	end1 = time.perf_counter()
+	elapsed = end1 - start1
+	for file in files:
+		skipped, extracted = counts[file]
+		if skipped > 0:
+			print("\nSkipped {} image file(s) already extracted from {}".format(skipped, file))
+		error = expected[file] - (skipped + extracted)
+		print("\nSuccessfully extracted {} image file(s) from {} with {} error(s) in {:.3f}s\n\n".format(extracted, file, error, elapsed))
+	return folders
+
+def countFrames(file, start, fps):
+	video = openVideo(file)
+	try:
+		times, _ = frameTimes(video, start, fps)
+	finally:
+		video.close()
+	return len(times)
+
+def rgbToRGBA(frame):
+	result = np.empty(frame.shape[:2] + (4,), dtype=np.uint8)
+	result[..., :3] = frame[..., :3]
+	result[..., 3] = 255
+	return result
+
+def iterFrames(file, start, fps):
+	# decode frames in order straight into RGBA arrays (no intermediate PNG)
+	video = openVideo(file)
+	try:
+		times, _ = frameTimes(video, start, fps)
+		for now in times:
+			with Instrument.stage("video decode"):
+				frame = rgbToRGBA(video.get_frame(now))
+			yield now, frame
+	finally:
+		video.close()
+
+def streamFrames(file, start, out, fps, outputPath, prefix, transform, seen=None, encoder=None):
+	# same frame selection and "frame#N" naming as frames(), but each decoded frame
+	# goes through transform() in memory and only the final image is written
+	if len(out) == 0:
+		out = file
+	name, _ = os.path.splitext(out)
+	folder = os.path.join(outputPath, os.path.basename(name))
+	start1 = time.perf_counter()
+
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+		print("Created output subdirectory \"{}\"".format(folder))
+
+	f = len(glob.glob(os.path.join(glob.escape(folder), "*.png")))
+	g = f
+	errorCount = 0
+	if encoder is None:
+		encoder = EncoderPool()
+	for now, frame in iterFrames(file, start, fps):
+		g+=1
+		outputFileName = os.path.join(folder, prefix + f"frame#{g}.png")
+		try:
+			key = frameHash(frame) if seen is not None else None
+			if reuseOutput(seen, key, outputFileName, encoder.copy):
+				continue
+			encoder.save(transform(frame), outputFileName)
+			rememberOutput(seen, key, outputFileName)
+		except Exception as e:
+			print("Error while processing frame at {:.3f}s of \"{}\":".format(now, file))
+			print(e)
+			errorCount += 1
+
+	end1 = time.perf_counter()
+	elapsed = end1 - start1
+	print("\nStreamed {} frame(s) from {} into \"{}\" with {} error(s) in {:.3f}s\n".format(g-f-errorCount, file, folder, errorCount, elapsed))
+	return g-f-errorCount, errorCount
@@ -0,0 +1,401 @@
+import os, os.path
+import sys
+import time
+import struct
+import threading
+import select
+import ctypes, ctypes.util
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from Headless import Gooey, GooeyParser
+from Video import VIDEO_EXTENSIONS, iterFrames
+from Manifest import Manifest, fileStamp
+from Encode import PNG_PROFILES
+from Pipeline import iterImageFiles
+from Mapping import hashMappingFile
+from Converter import ColorMapping, convertFrames
+
+# long-running mode: the mapping is loaded once and kept in memory while the input folders are watched,
+# every new (or changed) video or png is processed by a pool of worker threads as soon as it is complete,
+# and the completion manifest in the output folder is saved after every file
+
+WATCHED_EXTENSIONS = [".png"] + VIDEO_EXTENSIONS
+WATCH_MODES = ["auto", "poll", "inotify"]
+
+def settledFiles(folders, settle):
+	# a file counts as complete once it hasn't been modified for settle seconds (e.g. a video still being recorded)
+	now = time.time()
+	for folder in folders:
+		for extension in WATCHED_EXTENSIONS:
+			for fileName in iterImageFiles(folder, extension):
+				try:
+					if now - os.path.getmtime(fileName) >= settle:
+						yield fileName
+				except OSError: # removed in the meantime
+					pass
+
+class PollWatcher:
+	def __init__(self, folders, settle):
+		self.folders = folders
+		self.settle = settle
+		self.woken = threading.Event()
+		self.due = None # when the folders are listed next
+
+	def wait(self, timeout):
+		# returns early (with no files) when woken, e.g. by finished work; the folders are still listed every timeout seconds
+		if self.due is None:
+			self.due = time.monotonic() + timeout
+		self.woken.wait(max(0, self.due - time.monotonic()))
+		self.woken.clear()
+		if time.monotonic() < self.due:
+			return []
+		self.due = None
+		return list(settledFiles(self.folders, self.settle))
+
+	def wake(self):
+		# may be called from any thread
+		self.woken.set()
+
+	def close(self):
+		pass
+
+class InotifyWatcher:
+	# Linux only: reports files as soon as they are closed after writing or moved into a folder
+	IN_CLOSE_WRITE = 0x08
+	IN_MOVED_TO = 0x80
+	EVENT = struct.Struct("iIII") # watch descriptor, mask, cookie, name length
+
+	def __init__(self, folders):
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		self.fd = libc.inotify_init1(os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "Could not start inotify")
+		self.folders = {} # watch descriptor -> folder
+		for folder in folders:
+			wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+			if wd < 0:
+				os.close(self.fd)
+				raise OSError(ctypes.get_errno(), "Could not watch \"{}\"".format(folder))
+			self.folders[wd] = folder
+		self.wakeRead, self.wakeWrite = os.pipe() # wake() makes the pending select() return
+
+	def wait(self, timeout):
+		ready, _, _ = select.select([self.fd, self.wakeRead], [], [], timeout)
+		if self.wakeRead in ready:
+			os.read(self.wakeRead, 4096)
+		if self.fd not in ready:
+			return []
+		data = os.read(self.fd, 64 * 1024)
+		fileNames, i = [], 0
+		while i < len(data):
+			wd, mask, cookie, length = self.EVENT.unpack_from(data, i)
+			i += self.EVENT.size
+			name = os.fsdecode(data[i:i+length].rstrip(b"\0"))
+			i += length
+			if name and wd in self.folders and any(name.lower().endswith(extension) for extension in WATCHED_EXTENSIONS):
+				fileNames.append(os.path.join(self.folders[wd], name))
+		return fileNames
+
+	def wake(self):
+		# may be called from any thread
+		try:
+			os.write(self.wakeWrite, b"\0")
+		except OSError: # already closed
+			pass
+
+	def close(self):
+		os.close(self.fd)
+		os.close(self.wakeRead)
+		os.close(self.wakeWrite)
+
+def makeWatcher(mode, folders, settle):
+	if mode == "poll" or (mode == "auto" and not sys.platform.startswith("linux")):
+		return PollWatcher(folders, settle)
+	try:
+		return InotifyWatcher(folders)
+	except (OSError, AttributeError) as e: # AttributeError: no inotify in this libc
+		if mode == "inotify":
+			raise
+		print("inotify unavailable ({}), polling instead".format(e))
+		return PollWatcher(folders, settle)
+
+def writeOutput(fileName, data):
+	# written under a temporary name first, so other watchers never pick up a half written png
+	temporaryFileName = fileName + ".tmp"
+	with open(temporaryFileName, "wb") as outputFile:
+		outputFile.write(data)
+	os.replace(temporaryFileName, fileName)
+
+def processFile(fileName, outputPath, mapping, transparent, name, start, fps, png, batch=16):
+	# returns the number of images written; videos go to a folder named after them like streamFrames(),
+	# png files to a folder named after the one they came from
+	stem, extension = os.path.splitext(os.path.basename(fileName))
+	video = extension.lower() in VIDEO_EXTENSIONS
+	folder = os.path.join(outputPath, stem if video else os.path.basename(os.path.dirname(fileName)))
+	os.makedirs(folder, exist_ok=True)
+	if not video:
+		with open(fileName, "rb") as inputFile:
+			[data], _ = convertFrames(inputFile.read(), mapping, transparent, png)
+		writeOutput(os.path.join(folder, name + os.path.basename(fileName)), data)
+		return 1
+	count, frames = 0, []
+	def flush():
+		nonlocal count
+		results, _ = convertFrames(frames, mapping, transparent, png, batch)
+		for data in results:
+			count += 1
+			writeOutput(os.path.join(folder, name + f"frame#{count}.png"), data)
+		frames.clear()
+	for now, frame in iterFrames(fileName, start, fps):
+		frames.append(frame)
+		if len(frames) >= batch:
+			flush()
+	if len(frames) > 0:
+		flush()
+	return count
+
+def sharedFolders(folders, outputPath):
+	# watched folders that processFile() also writes outputs to (outputPath/<folder name>)
+	return [folder for folder in folders if os.path.dirname(os.path.abspath(folder)) == os.path.abspath(outputPath)]
+
+def isOutput(fileName, outputPath, folders, name=""):
+	# outputs only ever go to outputPath/<video stem or input folder name>/; in a folder that is also watched
+	# (see sharedFolders()), only the files carrying the name prefix are taken for outputs
+	folder = os.path.dirname(fileName)
+	if os.path.dirname(folder) != outputPath:
+		return False
+	if folder not in folders:
+		return True
+	return name != "" and os.path.basename(fileName).startswith(name)
+
+def timed(process, fileName):
+	# runs in the worker, so the time doesn't include waiting for the result to be collected
+	begin = time.perf_counter()
+	count = process(fileName)
+	return count, time.perf_counter() - begin
+
+def watch(folders, outputPath, manifest, watcher, process, workers=2, interval=1.0, settle=2.0, once=False, name=""):
+	# once: process what is already there, then stop instead of waiting for new files
+	futures = {} # future -> (fileName, stamp)
+	queued = {} # fileName -> stamp last submitted, so a file isn't processed twice (or retried) until it changes
+	outputPath = os.path.abspath(outputPath)
+	folders = [os.path.abspath(folder) for folder in folders]
+	processedCount, errorCount = 0, 0
+
+	def submit(fileName):
+		fileName = os.path.abspath(fileName)
+		if isOutput(fileName, outputPath, folders, name): # our own outputs, when an output folder is watched too
+			return
+		try:
+			stamp = fileStamp(fileName)
+		except OSError:
+			return
+		if manifest.isDone(fileName, stamp) or queued.get(fileName) == stamp:
+			return
+		queued[fileName] = stamp
+		future = executor.submit(timed, process, fileName)
+		futures[future] = (fileName, stamp)
+		future.add_done_callback(lambda future: watcher.wake()) # results are collected right away, not at the next check
+
+	def collect(done):
+		nonlocal processedCount, errorCount
+		for future in done:
+			fileName, stamp = futures.pop(future)
+			try:
+				count, elapsed = future.result()
+			except Exception as e:
+				print("Error while processing \"{}\":".format(fileName))
+				print(e)
+				errorCount += 1
+				continue
+			manifest.complete(fileName, stamp)
+			manifest.save()
+			processedCount += 1
+			print("Processed \"{}\" into {} image file(s) (took {:.3f}s)".format(fileName, count, elapsed))
+
+	with ThreadPoolExecutor(max(1, workers)) as executor:
+		try:
+			for fileName in settledFiles(folders, settle):
+				submit(fileName)
+			while True:
+				if len(futures) > 0:
+					done, _ = wait(futures, timeout=0 if not once else None, return_when=FIRST_COMPLETED)
+					collect(done)
+				if once:
+					if len(futures) == 0:
+						break
+					continue
+				for fileName in watcher.wait(interval):
+					submit(fileName)
+		except KeyboardInterrupt:
+			print("\nStopping, waiting for the files in progress...")
+			collect(wait(futures).done)
+		finally:
+			watcher.close()
+			manifest.save()
+	return processedCount, errorCount
+
+@Gooey(program_description="Watches folders and reverts the palettes and/or removes black of every new video or png file, keeping the mapping loaded.", default_size=(690, 600), optional_cols=1, tabbed_groups=True)
+def main():
+	cwd = os.path.abspath(os.getcwd())
+	defaultInversePaletteMappingFileName = "new_palette\inversePaletteMapping.txt"
+	defaultOutputPath = "output"
+
+	parser = GooeyParser()
+	input_group = parser.add_argument_group(
+		"Input",
+		"Name the folder(s) to watch, e.g. the one Record.py saves the videos to.")
+	input_group.add_argument("-f", "--inputFolders",
+		nargs="+",
+		help="Name(s)/path(s) of the folder(s) to watch for new videos and PNG image files.",
+		widget="DirChooser")
+	input_group.add_argument("-m", "--mapping",
+		dest="mapping",
+		default=os.path.join(cwd, defaultInversePaletteMappingFileName),
+		help="Name/path of inverse palette mapping file.",
+		widget="FileChooser")
+	input_group.add_argument("-nr", "--no_reverse",
+		action="store_true",
+		help="Skip reverting the generated palettes to the originals.")
+	input_group.add_argument("-t", "--transparent",
+		action="store_true",
+		help="Change true black into full transparency.")
+
+	video_group = parser.add_argument_group(
+		"Video Options",
+		"Set the parameters for image extraction from the video(s).")
+	video_group.add_argument("-s", "--start",
+		type=float,
+		default=0,
+		help="Time in seconds at which to start extracting frames from the video(s). Defaults to 0.",
+		widget="DecimalField",
+		gooey_options={'max':1000})
+	video_group.add_argument("-i", "--fps",
+		type=float,
+		default=0,
+		help="Number of frames per second to save from the video. Defaults to every frame.",
+		widget="DecimalField")
+
+	output_group = parser.add_argument_group(
+		"Output",
+		"Customize output options.")
+	output_group.add_argument("-n", "--name",
+		default="",
+		help="Name string to attach to each output file.")
+	output_group.add_argument("-o", "--out",
+		dest="outputPath",
+		default=os.path.join(cwd, defaultOutputPath),
+		help="Path to store output images and the completion manifest.",
+		widget="DirChooser")
+	output_group.add_argument("-fr", "--fresh",
+		action="store_true",
+		help="Ignore the completion manifest and process every file already in the folders again.")
+	output_group.add_argument("-d", "--default",
+		action="store_true",
+		help="Set the current values as the new default configuration.")
+
+	watch_group = parser.add_argument_group(
+		"Watching",
+		"How new files are noticed and processed.")
+	watch_group.add_argument("-w", "--watch",
+		default="auto",
+		choices=WATCH_MODES,
+		help="How to notice new files. 'auto' uses inotify on Linux and polling elsewhere.",
+		widget="Dropdown")
+	watch_group.add_argument("-pi", "--poll_interval",
+		type=float,
+		default=1.0,
+		help="Seconds between two checks of the folders when polling.",
+		widget="DecimalField")
+	watch_group.add_argument("-se", "--settle",
+		type=float,
+		default=2.0,
+		help="Seconds a file must go unmodified before it is processed when polling, so videos still being recorded are left alone.",
+		widget="DecimalField")
+	watch_group.add_argument("-j", "--workers",
+		type=int,
+		default=2,
+		help="Number of files processed at the same time.",
+		widget="IntegerField")
+	watch_group.add_argument("-pp", "--png_profile",
+		default="default",
+		choices=list(PNG_PROFILES),
+		help="PNG compression profile for output images. 'fast' suits intermediate frames, 'small' final ones.",
+		widget="Dropdown")
+	watch_group.add_argument("-on", "--once",
+		action="store_true",
+		help="Process the files already in the folders, then stop instead of watching.")
+
+	args = vars(parser.parse_args()) # convert parsed arguments into dict
+	folders = [os.path.abspath(folder) for folder in args["inputFolders"] or [] if os.path.isdir(folder)]
+	reverse = not args["no_reverse"]
+	transparent = args["transparent"]
+	start = args["start"]
+	fps = args["fps"]
+	name = args["name"]
+	outputPath = os.path.abspath(args["outputPath"])
+	workers = args["workers"]
+	png_profile = args["png_profile"]
+	watch_mode = args["watch"]
+	poll_interval = args["poll_interval"]
+	settle = args["settle"]
+	default = args["default"]
+
+	if len(folders) == 0 or not (reverse or transparent):
+		parser.print_help()
+		sys.exit()
+
+	for folder in sharedFolders(folders, outputPath):
+		if name == "":
+			print("ERROR: The outputs of \"{}\" would overwrite its files; pick another output folder or an output name.".format(folder))
+			return 1
+		print("WARNING: \"{}\" is also an output folder, its files starting with \"{}\" are taken for outputs and skipped.".format(folder, name))
+	if not os.path.exists(outputPath):
+		os.makedirs(outputPath)
+		print("Created output directory \"{}\"".format(outputPath))
+	mapping = None
+	if reverse:
+		inversePaletteMappingPath = os.path.abspath(args["mapping"])
+		mapping = ColorMapping.load(inversePaletteMappingPath)
+		print("Loaded inverse color mapping in {:.3f}s".format(mapping.loadSeconds))
+	settings = {"mapping": hashMappingFile(mapping.fileName) if mapping is not None else None, "distance": mapping.distance if mapping is not None else 0,
+		"transparent": transparent, "name": name, "start": start, "fps": fps, "png": png_profile}
+	manifest = Manifest(os.path.join(outputPath, "Watch.manifest.json"), settings, args["fresh"])
+	watcher = makeWatcher(watch_mode, folders, settle)
+	process = lambda fileName: processFile(fileName, outputPath, mapping, transparent, name, start, fps, png_profile)
+	if not args["once"]:
+		print("Watching {} (stop with Ctrl+C)".format(", ".join("\"{}\"".format(folder) for folder in folders)))
+
+	start1 = time.perf_counter()
+	processedCount, errorCount = watch(folders, outputPath, manifest, watcher, process, workers, poll_interval, settle, args["once"], name)
+	end1 = time.perf_counter()
+	elapsed = end1 - start1
+	print("\nProcessed {} file(s) with {} error(s) in {:.3f}s".format(processedCount, errorCount, elapsed))
+
+	if default == True:
+		mapping = repr(args["mapping"]) #Convert quotes into double quotes so the address is written later with quotes + deal with escape characters
+		name = repr(name)
+		output = repr(args["outputPath"])
+		data=[mapping, start, fps, name, output, repr(watch_mode), poll_interval, settle, workers, repr(png_profile)]
+		j=0
+		with open("Watch.py","r") as e:
+			new = e.read().splitlines(True) #Grab each line and keep the \n endline character
+			e.close()
+		for i in range(len(data)):
+			while new[j].find("default=") == -1:
+				j+=1
+			l = new[j].split("default=")
+			new_line = l[0] + "default=" + str(data[i]) + ',\n'
+			if new[j-1].find('#') == -1 and new[j] != new_line:
+				new[j] = '#' + new[j].replace("default=","default(base)=")
+				j+=1
+				new.insert(j, new_line)
+			else:
+				new[j] = new_line
+			j+=1
+		with open("Watch.py","w") as e:
+			e.write(''.join(new))
+			e.close()
+
+if __name__ == "__main__":
+    result = main()
+    sys.exit(result)